@@ -0,0 +1,308 @@
+''' Compares the speed and memory use of the petit_lisp versions
+
+Each version, vN/petit_lisp.py, the top-level petit_lisp.py ("top") and
+new/petit_lisp.py ("new", or "new:ENGINE" to select one of its engines),
+is imported in a separate Python process and runs the workloads whose
+features it supports; these are found by evaluating a few small
+expressions first.  For each workload, the number of times it can be
+run per second, and the peak memory allocated while running it once, as
+measured by tracemalloc, are reported.
+
+Given --output, the results are also written there as JSON; given the
+results of an earlier run, the ratio of the current speed to the earlier
+one is shown as well.
+
+usage: python benchmark_versions.py [version ...] [--output results.json]
+                                    [--compare earlier.json]
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name: (setup expressions, expression, expected value)
+FEATURES = {
+    'define': (["(define probe 3)"], "probe", 3),
+    'lambda': (["(define probe (lambda (x) (* x x)))"], "(probe 3)", 9),
+    'if': ([], "(if (< 1 2) (+ 1 0) 2)", 1),
+    'lists': ([], "(car (cdr (cons 1 (cons 2 (quote ())))))", 2),
+    'null?': ([], "(if (null? (quote ())) 1 2)", 1),
+    'strings': ([], '"a \\"b\\""', 'a "b"'),
+}
+
+PROGRAM_SIZE = 2000     # number of top-level forms of the "load" workload
+
+
+class Workload:
+    '''A program run repeatedly by each version supporting its features'''
+
+    def __init__(self, name, features, setup, expression, expected):
+        self.name, self.features = name, features
+        self.setup, self.expression, self.expected = setup, expression, expected
+
+    def prepare(self, lisp):
+        for expr in self.setup:
+            lisp.evaluate(expr)
+        return lambda: lisp.evaluate(self.expression)
+
+    def cleanup(self):
+        '''Removes what prepare made, once the workload has been measured'''
+        pass
+
+
+class ParseWorkload(Workload):
+    '''Parsing, without evaluating, a long expression'''
+
+    def prepare(self, lisp):
+        return lambda: lisp.parse(self.expression)
+
+
+class LoadWorkload(Workload):
+    '''Loading a file with many top-level forms'''
+    directory = None     # the TemporaryDirectory holding the file
+
+    def prepare(self, lisp):
+        self.directory = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.directory.name, "program.lisp")
+        with open(filename, "w") as f:
+            for i in range(PROGRAM_SIZE):
+                f.write("(define v{} (+ {} 1))  ; form {}\n".format(i, i, i))
+
+        def load():
+            lisp.load(filename)
+            return lisp.evaluate("v{}".format(PROGRAM_SIZE - 1))
+        return load
+
+    def cleanup(self):
+        if self.directory is not None:     # with the __lispcache__ of new/
+            self.directory.cleanup()
+            self.directory = None
+
+
+def nested_expression(depth, width):
+    '''Returns the text of an expression with many symbols and numbers'''
+    if depth == 0:
+        return "(symbol-with-a-long-name 12 3.5 another_symbol)"
+    return "(begin-list {})".format(
+        " ".join(nested_expression(depth - 1, width) for _ in range(width)))
+
+
+def string_expression(count):
+    '''Returns the text of a list of many string literals, some escaped'''
+    return "(list {})".format(" ".join(
+        r'"string {} with \"quotes\" and a \\ backslash"'.format(i)
+        if i % 4 == 0 else '"plain string number {}"'.format(i)
+        for i in range(count)))
+
+
+WORKLOADS = [
+    Workload('fib', ['define', 'lambda', 'if'],
+             ["""(define fib (lambda (n)
+                    (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))"""],
+             "(fib 15)", 610),
+    Workload('tak', ['define', 'lambda', 'if'],
+             ["""(define tak (lambda (x y z) (if (< y x)
+                    (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y))
+                    z)))"""],
+             "(tak 12 8 4)", 5),
+    Workload('append-reverse', ['define', 'lambda', 'if', 'lists', 'null?'],
+             ["""(define rev (lambda (l acc)
+                    (if (null? l) acc (rev (cdr l) (cons (car l) acc)))))""",
+              """(define app (lambda (a b)
+                    (if (null? a) b (cons (car a) (app (cdr a) b)))))""",
+              """(define upto (lambda (n acc)
+                    (if (= n 0) acc (upto (- n 1) (cons n acc)))))""",
+              "(define items (upto 100 (quote ())))"],
+             "(car (rev (app items items) (quote ())))", 100),
+    Workload('deep-recursion', ['define', 'lambda', 'if'],
+             ["(define depth (lambda (n) (if (= n 0) 0 (+ 1 (depth (- n 1))))))"],
+             "(depth 1000)", 1000),
+    ParseWorkload('parse', [], [], nested_expression(4, 6), None),
+    ParseWorkload('parse-strings', ['strings'], [], string_expression(2000), None),
+    LoadWorkload('load', ['define', 'load'], [], None, PROGRAM_SIZE),
+]
+
+
+class Version:
+    '''The interface to an imported petit_lisp module, run in a worker'''
+
+    def __init__(self, name):
+        self.name = name
+        name, _, engine = name.partition(':')
+        directory = HERE if name == 'top' else os.path.join(HERE, name)
+        sys.path.insert(0, directory)
+        os.chdir(directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import petit_lisp
+            if hasattr(petit_lisp, 'FileLoader'):     # new
+                petit_lisp.FileLoader("default_language.lisp")
+                if engine:
+                    petit_lisp.set_engine(engine)
+        if hasattr(petit_lisp, 'REPL_STARTED'):       # do not start the repl
+            petit_lisp.REPL_STARTED = True             # after loading a file
+        self.module = petit_lisp
+
+    def parse(self, s):
+        return self.module.parse(s)
+
+    def evaluate(self, s):
+        return self.module.evaluate(self.module.parse(s))
+
+    def load(self, filename):
+        loader = getattr(self.module, 'FileLoader', None) or self.module.load
+        with contextlib.redirect_stdout(io.StringIO()):
+            loader(filename)
+
+    def supports(self, feature):
+        if feature == 'load':
+            return hasattr(self.module, 'FileLoader') or hasattr(self.module, 'load')
+        setup, expression, expected = FEATURES[feature]
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for expr in setup:
+                    self.evaluate(expr)
+                return self.evaluate(expression) == expected
+        except Exception:
+            return False
+
+
+def measure(run, min_time):
+    '''Returns the number of runs per second and the peak memory, in KiB'''
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    count, start = 0, time.perf_counter()
+    while True:
+        run()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed, peak / 1024
+
+
+def run_worker(name, min_time):
+    '''Runs the workloads with one version; returns the results by workload'''
+    version = Version(name)
+    features = {}
+    results = {}
+    for workload in WORKLOADS:
+        missing = [f for f in workload.features
+                   if features.setdefault(f, version.supports(f)) is False]
+        if missing:
+            results[workload.name] = {'skipped': "needs " + ", ".join(missing)}
+            continue
+        try:
+            run = workload.prepare(version)
+            value = run()
+            if workload.expected is not None and value != workload.expected:
+                raise ValueError("got {!r}, expected {!r}".format(
+                    value, workload.expected))
+            ops, peak = measure(run, min_time)
+            results[workload.name] = {'ops_per_sec': ops, 'peak_kib': peak}
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+            results[workload.name] = {'error': error}
+        finally:
+            workload.cleanup()
+    return results
+
+
+def worker_main(name, min_time):
+    # old versions evaluate recursively: give deep recursion room to run
+    sys.setrecursionlimit(100000)
+    threading.stack_size(512 * 1024 * 1024)
+    output = {}
+    thread = threading.Thread(
+        target=lambda: output.update(run_worker(name, min_time)))
+    thread.start()
+    thread.join()
+    print(json.dumps(output))
+
+
+def all_versions():
+    names = [d for d in os.listdir(HERE)
+             if d.startswith('v')
+             and os.path.isfile(os.path.join(HERE, d, 'petit_lisp.py'))]
+    names.sort(key=lambda d: [float(d[1:])])
+    return names + ['top', 'new']
+
+
+def run(versions, min_time):
+    '''Returns the results of each version, each run in its own process'''
+    results = {}
+    for name in versions:
+        print("running {}...".format(name), file=sys.stderr)
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', name,
+             '--min-time', str(min_time)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            results[name] = json.loads(process.stdout.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            results[name] = {w.name: {'error': 'worker failed'} for w in WORKLOADS}
+    return results
+
+
+def report(results, earlier=None):
+    '''Prints the runs per second, the peak memory and, given earlier
+       results, the speed ratio, of each version for each workload'''
+    print("{:16}{:>8}{:>16}{:>12}{:>10}".format(
+        "workload", "version", "runs/s", "peak KiB", "ratio"))
+    for workload in WORKLOADS:
+        for name, by_workload in results.items():
+            result = by_workload.get(workload.name, {})
+            if 'ops_per_sec' not in result:
+                note = result.get('skipped') or result.get('error')
+                print("{:16}{:>8}  {}".format(workload.name, name, note))
+                continue
+            ratio = ""
+            try:
+                before = earlier[name][workload.name]['ops_per_sec']
+                ratio = "{:.2f}".format(result['ops_per_sec'] / before)
+            except (TypeError, KeyError):
+                pass
+            print("{:16}{:>8}{:>16.1f}{:>12.1f}{:>10}".format(
+                workload.name, name, result['ops_per_sec'], result['peak_kib'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="petit_lisp versions benchmark")
+    parser.add_argument("versions", nargs="*",
+                        help="v1 ... v11, top, new or new:ENGINE (default: all)")
+    parser.add_argument("--output",
+                        help="file to which the results are written as JSON")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="seconds during which each workload is repeated")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker_main(args.worker, args.min_time)
+        return
+
+    results = run(args.versions or all_versions(), args.min_time)
+    earlier = None
+    if args.compare:
+        with open(args.compare) as f:
+            earlier = json.load(f)['results']
+    report(results, earlier)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'python': platform.python_version(),
+                       'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+'''Evaluation of the independent top-level forms of a file in parallel
+
+In batch mode, the forms read by FileLoader are grouped before being
+evaluated.  A form can join the current group if it is pure, that is if
+it cannot change the environment or print anything, and if it does not
+use a variable defined by a form already in the group, either directly
+or through the procedures it calls.  Calls in a group, such as
+(define a (fib 25)) or (count-primes 10000), are then evaluated at the
+same time by a pool of processes, each started with a copy of the
+global environment as it was when the group was complete.
+
+The results are given back to FileLoader in source order: variables
+defined by the group are set in global_env, and errors are reported,
+exactly as if the forms had been evaluated one after the other.  Forms
+which are not pure, such as (load-py 'my_math) or (display x), are
+evaluated in the main process once the forms before them are done.
+
+Pools of processes are only used where they can be started by forking
+the current process, and if there is more than one cpu; otherwise, all
+forms are evaluated in turn.
+
+usage: python petit_lisp.py --batch program.lisp
+'''
+
+import concurrent.futures
+import multiprocessing
+import os
+
+import my_math
+import petit_lisp as pl
+
+# Builtins which neither change the environment nor print anything; a
+# variable bound to any other Python function is assumed to do so.
+PURE_FUNCTIONS = frozenset(
+    [pl.common_env(None)[name] for name in [
+        'begin', 'atom?', 'eq?', 'car', 'cdr', '/', '//', '>', '<', '>=',
+        '<=', '=', 'not', 'append', 'list', 'last', 'add', 'length',
+        'reverse', 'map', 'filter', 'reduce', 'vector', 'make-vector',
+        'vector-ref', 'vector-length', 'vector->list', 'list->vector']] +
+    [my_math.my_sum, my_math.my_prod, my_math.my_sub, my_math.sum_items, my_math.dot])
+
+
+class Impure(Exception):
+    '''Raised for a form which may change the environment'''
+    pass
+
+
+def free_variables(x, bound=frozenset()):
+    '''Returns the variables used by x which are not bound within x;
+       raises Impure if x sets a variable or defines a global one'''
+    if isinstance(x, str) and not isinstance(x, pl.String):
+        return set() if x in bound else {x}
+    if not isinstance(x, list) or not x:
+        return set()
+    first = x[0]
+    if type(first) is not str:
+        first = None        # only symbols name special forms
+    if first == 'quote':
+        return set()
+    elif first in ('set!', 'define-memo', 'profile'):
+        raise Impure(x)
+    elif first == 'define':
+        (_, var, exp) = x
+        if var not in bound:        # only local definitions are allowed
+            raise Impure(x)
+        return free_variables(exp, bound)
+    elif first == 'lambda':
+        (_, params, body) = x
+        bound = bound.union(params, pl.analyzer.local_definitions(body))
+        return free_variables(body, bound)
+    names = set()
+    for exp in x:
+        names |= free_variables(exp, bound)
+    if first in pl.analyzer.special_forms:
+        names.discard(first)
+    return names
+
+
+class Scheduler:
+    '''Groups forms that can be evaluated in parallel'''
+
+    def __init__(self, env=pl.global_env):
+        self.env = env
+        # name: (Procedure made by a pure form, free variables of the form)
+        self.pure_procedures = {}
+
+    def is_pure(self, name, defining=None, seen=None):
+        '''True if using the global variable name cannot have side effects,
+           given the current values of the variables its procedure uses'''
+        if name == defining:        # recursive procedure being defined
+            return True
+        if name not in self.env:
+            return False
+        value = self.env[name]
+        if isinstance(value, pl.Procedure):
+            procedure, free = self.pure_procedures.get(name, (None, ()))
+            if procedure is not value:
+                return False
+            seen = set() if seen is None else seen
+            if name in seen:        # a procedure calling itself
+                return True
+            seen.add(name)
+            return all(self.is_pure(var, defining, seen) for var in free)
+        elif callable(value):
+            try:
+                return value in PURE_FUNCTIONS
+            except TypeError:    # unhashable
+                return False
+        return True
+
+    def reads(self, free):
+        '''Returns the global variables read by a form using the variables
+           free, including those read by the procedures it calls'''
+        names, waiting = set(), list(free)
+        while waiting:
+            name = waiting.pop()
+            if name not in names:
+                names.add(name)
+                procedure, used = self.pure_procedures.get(name, (None, ()))
+                if procedure is not None and procedure is self.env.get(name):
+                    waiting.extend(used)
+        return names
+
+    def defines(self, form):
+        '''Returns the variable defined by a top-level form, if any'''
+        if (isinstance(form, list) and len(form) == 3 and type(form[0]) is str
+                and form[0] == 'define' and isinstance(form[1], str)):
+            return form[1]
+        return None
+
+    def schedule(self, forms):
+        '''Yields (line, column, form, get_value) in source order, where
+           get_value() evaluates the form, or waits for the result of
+           its evaluation by another process; it must be called before
+           the next item is asked for.'''
+        group = []     # (line, column, form, name, exp, free) waiting
+        defined = set()
+        for line, column, form in forms:
+            name = self.defines(form)
+            exp = form[2] if name is not None else form
+            try:
+                free = free_variables(exp)
+            except Impure:
+                free = None
+            if free is None or self.reads(free) & defined:
+                yield from self.run(group)
+                group, defined = [], set()
+            is_lambda = isinstance(exp, list) and exp[:1] == ['lambda']
+            recursive = name if is_lambda else None
+            if free is not None and all(self.is_pure(var, recursive) for var in free):
+                group.append((line, column, form, name, exp, free))
+                if name is not None:
+                    defined.add(name)
+            else:
+                yield from self.run(group)
+                group, defined = [], set()
+                yield line, column, form, lambda form=form: pl.evaluate(form)
+        yield from self.run(group)
+
+    def run(self, group):
+        '''Yields the items of a group, evaluating its calls in parallel'''
+        calls = [exp for (_, _, _, _, exp, _) in group if is_call(exp)]
+        workers = min(len(calls), os.cpu_count() or 1)
+        if workers < 2 or not can_fork():
+            for line, column, form, name, exp, free in group:
+                yield line, column, form, self.getter(name, exp, free, None)
+            return
+        executor = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('fork'))
+        try:
+            futures = {id(exp): executor.submit(evaluate_in_worker, exp)
+                       for exp in calls}
+            for line, column, form, name, exp, free in group:
+                yield line, column, form, self.getter(name, exp, free,
+                                                      futures.get(id(exp)))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def getter(self, name, exp, free, future):
+        '''Returns a function giving the value of a form evaluated in the
+           main process, or by another process if future is not None'''
+        def get_value():
+            if future is None:
+                value = pl.evaluate(exp)
+            else:
+                try:
+                    value = future.result()
+                except Exception:     # evaluated again, to report errors
+                    value = pl.evaluate(exp)
+            if name is None:
+                return value
+            self.env[name] = value
+            if isinstance(value, pl.Procedure):
+                self.pure_procedures[name] = (value, free)
+            return None
+        return get_value
+
+
+def is_call(exp):
+    '''True if exp is a procedure call, rather than a cheap special form'''
+    return (isinstance(exp, list) and bool(exp) and
+            not (type(exp[0]) is str and exp[0] in pl.analyzer.special_forms))
+
+
+def can_fork():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def evaluate_in_worker(exp):
+    '''Run in a worker process, which has a copy of the global environment'''
+    return pl.evaluate(exp)
+
+
+def schedule(forms):
+    '''Yields (line, column, form, get_value) for the forms read from a file'''
+    return Scheduler().schedule(forms)
@@ -0,0 +1,125 @@
+''' Compares the time taken by the petit_lisp engines on a few workloads,
+or, with pmap, the time taken by map and pmap on a long list, or, with
+parse, the number of tokens parsed per second, or, with calls, the time
+taken by a call of a few builtins
+
+usage: python benchmark.py [engine ...]
+       python benchmark.py pmap [number_of_items]
+       python benchmark.py parse [number_of_definitions]
+       python benchmark.py calls [number_of_calls]
+'''
+import os
+import sys
+import time
+
+import petit_lisp as pl
+
+DEFINITIONS = [
+    "(define fib (lambda (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))",
+    """(define tak (lambda (x y z)
+        (if (not (< y x)) z
+            (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y)))))""",
+    "(define count-down (lambda (n) (if (= n 0) 'done (count-down (- n 1)))))",
+    "(define build (lambda (n acc) (if (= n 0) acc (build (- n 1) (cons n acc)))))",
+]
+
+WORKLOADS = [
+    ("fib", "(fib 18)"),
+    ("tak", "(tak 12 8 4)"),
+    ("loop", "(count-down 20000)"),
+    ("cons", "(build 2000 '())"),
+]
+
+
+def best_time(expr, repeat=3):
+    '''Returns the shortest time taken to evaluate an expression'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pl.evaluate(expr)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(engines):
+    '''Prints, for each workload, the time taken by each engine'''
+    results = {}
+    for engine in engines:
+        pl.set_engine(engine)
+        for definition in DEFINITIONS:   # procedures specific to the engine
+            pl.evaluate(pl.parse(definition))
+        for name, expr in WORKLOADS:
+            results[name, engine] = best_time(pl.parse(expr))
+    pl.set_engine('compile')
+
+    print("{:10}".format("workload") + "".join("{:>12}".format(e) for e in engines))
+    for name, _ in WORKLOADS:
+        print("{:10}".format(name) +
+              "".join("{:>11.4f}s".format(results[name, e]) for e in engines))
+
+
+MAP_DEFINITION = """(define horner (lambda (x k acc)
+    (if (= k 0) acc (horner x (- k 1) (+ (* acc x) k)))))"""
+
+
+def compare_map(n=100000):
+    '''Prints the time taken by map and pmap to evaluate a polynomial
+       at n points'''
+    pl.evaluate(pl.parse(MAP_DEFINITION))
+    pl.evaluate(pl.parse("(define poly (lambda (x) (horner x 8 0)))"))
+    pl.global_env['points'] = pl.Pair.from_list(range(n))
+    times = {}
+    for name in ["map", "pmap"]:
+        times[name] = best_time(pl.parse("({} poly points)".format(name)), repeat=1)
+    print("{} items, {} cpus".format(n, os.cpu_count()))
+    for name, t in times.items():
+        print("{:10}{:>11.4f}s".format(name, t))
+    print("speedup   {:>11.2f}".format(times["map"] / times["pmap"]))
+
+
+PARSE_DEFINITION = """(define (count-items-{0} lst acc)  ; mostly symbols
+    (if (null? lst) acc (count-items-{0} (cdr lst) (+ acc 1 2.5 -3))))
+"""
+
+
+def parse_throughput(n=5000):
+    '''Prints the number of tokens of a program parsed per second'''
+    program = "".join(PARSE_DEFINITION.format(i) for i in range(n))
+    parser = pl.Parser()
+    ntokens = sum(1 for _ in parser.scan(program))
+    start = time.perf_counter()
+    for _ in parser.read_all(parser.scan(program)):
+        pass
+    elapsed = time.perf_counter() - start
+    print("{} tokens in {:.4f}s: {:.0f} tokens/s".format(
+        ntokens, elapsed, ntokens / elapsed))
+
+
+def call_overhead(n=200000):
+    '''Prints the time taken by calls of car, cdr and eq? made through
+       petit_lisp's call, which all the engines use for Python functions,
+       and the part of it spent deciding how to call them'''
+    lst = pl.Pair.from_list([1, 2, 3])
+    print("{:10}{:>12}{:>12}".format("builtin", "per call", "overhead"))
+    for name, args in [("car", [lst]), ("cdr", [lst]), ("eq?", [1, 1])]:
+        procedure = pl.global_env[name]
+        times = []
+        for function in [lambda: procedure(*args),
+                         lambda: pl.call(procedure, args, pl.global_env)]:
+            start = time.perf_counter()
+            for _ in range(n):
+                function()
+            times.append((time.perf_counter() - start) / n * 1e9)
+        print("{:10}{:>10.0f}ns{:>10.0f}ns".format(name, times[1], times[1] - times[0]))
+
+
+if __name__ == "__main__":
+    pl.FileLoader("default_language.lisp")
+    if sys.argv[1:2] == ["pmap"]:
+        compare_map(*[int(arg) for arg in sys.argv[2:]])
+    elif sys.argv[1:2] == ["parse"]:
+        parse_throughput(*[int(arg) for arg in sys.argv[2:]])
+    elif sys.argv[1:2] == ["calls"]:
+        call_overhead(*[int(arg) for arg in sys.argv[2:]])
+    else:
+        run(sys.argv[1:] or ["interpret", "compile", "vm", "jit"])
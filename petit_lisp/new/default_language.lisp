@@ -2,26 +2,10 @@
 (define + my_sum)
 (define * my_prod)
 (define - my_sub)
+(define sum sum_items)   ; dot is loaded from my_math as it is
 (define else #t)
-(define last (lambda (y) (cond ( (null? (cdr y)) (car y)) (else (last (cdr y))))))
-(define append (lambda (x y)
-    (cond ( (null? x) y)
-        (else (cons (car x) (append (cdr x) y))))))
-(define list (lambda (x . y) (append (cons x '()) y)))
-(define add (lambda (x y . z)
-    (cond ((null? z) (+ x y))
-          (else (add (+ x y) (car z) (cdr z))))
-    ))
-(define and (lambda (x . y)
-    (cond ( (not x) #f)
-        ((null? y) #t)
-          (else (and (car y) (cdr y))))
-    ))
-(define or (lambda (x . y)
-    (cond ( x #t)
-        ((null? y) #f)
-          (else (or (car y) (cdr y))))
-    ))
+;; append, list, last, add, map, filter, reduce, length and reverse
+;; are defined natively, in prelude.py; and, or are special forms.
 
 ;; the following does not work as expected since both "other" and
 ;; "if_true" would be evaluated
@@ -0,0 +1,184 @@
+'''Constant folding of parsed petit_lisp expressions
+
+Before an expression is evaluated, calls of pure builtins whose
+arguments are all numbers or booleans, such as (+ (* 3 4) (- 2 1)), are
+replaced by their value, and if or cond expressions whose test has a
+known value are replaced by the branch that would be taken.  This is
+done once, instead of each time a procedure body containing them runs.
+
+A call is folded only if its procedure is a global variable which is
+bound, when the expression is folded, to one of the FOLDABLE functions;
+a variable bound by an enclosing lambda expression, or defined or set
+within the expression itself, is never folded, and neither is a call
+evaluated after a call to any other procedure in the same body, since
+that procedure may set the variable.  The folded body of a lambda
+expression is used only while the variables it relied on keep their
+value, as checked by a Guard each time the body runs; once a builtin
+such as + is given another value, the original body is run instead.
+Folding can be turned off with set_folding in petit_lisp, or with the
+--no-fold option.
+'''
+
+import operator
+
+import my_math
+import petit_lisp as pl
+
+FOLDABLE = frozenset([
+    my_math.my_sum, my_math.my_prod, my_math.my_sub,
+    operator.truediv, operator.floordiv, operator.gt, operator.lt,
+    operator.ge, operator.le, operator.eq, operator.not_])
+
+CONSTANT_NAMES = frozenset(['#t', '#f', 'else'])   # when bound to a boolean
+
+NUMBER_TYPES = (bool, int, float, complex)
+
+
+def is_constant(x):
+    return type(x) in NUMBER_TYPES
+
+
+def assigned(x):
+    '''Returns the names given a value by define or set! within x'''
+    names = set()
+    if isinstance(x, list) and x:
+        first = x[0] if type(x[0]) is str else None    # a symbol
+        if first == 'quote':
+            return names
+        if first in ('define', 'define-memo', 'set!') and len(x) > 2:
+            names.add(x[1])
+        for exp in x:
+            names |= assigned(exp)
+    return names
+
+
+class Guard:
+    '''Called by a folded lambda body: true while the global variables it
+       relied on are bound to the same values as when it was folded'''
+
+    def __init__(self, env, values):
+        self.env = env
+        self.values = list(values.items())
+
+    def __call__(self):
+        get = self.env.get
+        for var, value in self.values:
+            if get(var) is not value:
+                return False
+        return True
+
+
+class Folder:
+    '''Folds the constant parts of a single expression'''
+
+    def __init__(self, x, env=pl.global_env):
+        self.env = env
+        self.assigned = assigned(x)
+        self.used = {}     # global variables whose value was relied on
+        self.called = False     # passed a call which may set a variable
+
+    def global_value(self, var, bound):
+        '''Returns the value of a global variable which may be relied on,
+           or None'''
+        if (self.called or var in bound or var in self.assigned or
+                var not in self.env):
+            return None
+        return self.env[var]
+
+    def rely_on(self, var):
+        self.used[var] = self.env[var]
+
+    def constant_value(self, x, bound):
+        '''Returns (True, value) if the value of x is known, or (False, None)'''
+        if is_constant(x):
+            return True, x
+        if isinstance(x, str) and not isinstance(x, pl.String) and x in CONSTANT_NAMES:
+            value = self.global_value(x, bound)
+            if type(value) is bool:
+                self.rely_on(x)
+                return True, value
+        return False, None
+
+    def fold(self, x, bound=frozenset()):
+        '''Returns x, or an equivalent expression with its constant parts
+           replaced by their value; x itself is not modified.'''
+        if not isinstance(x, list) or not x:
+            return x
+        first = x[0]
+        if type(first) is not str:
+            x = [self.fold(exp, bound) for exp in x]
+            self.called = True
+            return x
+        elif first == 'quote':
+            return x
+        elif first == 'lambda':
+            (_, params, body) = x
+            bound = bound.union(params, pl.analyzer.local_definitions(body))
+            return ['lambda', params, self.fold_body(body, bound)]
+        elif first in ('define', 'define-memo', 'set!'):
+            return x[:2] + [self.fold(exp, bound) for exp in x[2:]]
+        elif first == 'if' and len(x) == 4:
+            (_, test, if_true, other) = x
+            test = self.fold(test, bound)
+            known, value = self.constant_value(test, bound)
+            if known:
+                return self.fold(if_true if value else other, bound)
+            return ['if', test, self.fold(if_true, bound), self.fold(other, bound)]
+        elif first == 'cond' and all(isinstance(c, list) and len(c) == 2
+                                     for c in x[1:]):
+            return self.fold_cond(x, bound)
+        x = [first] + [self.fold(exp, bound) for exp in x[1:]]
+        if first not in pl.analyzer.special_forms:
+            return self.fold_call(x, bound)
+        return x
+
+    def fold_body(self, body, bound):
+        '''Returns the body of a lambda expression, folded if possible:
+           (if (guard) folded_body body)'''
+        used, called = self.used, self.called
+        self.used, self.called = {}, False
+        try:
+            folded = self.fold(body, bound)
+            if not self.used:
+                return folded
+            return ['if', [Guard(self.env, self.used)], folded, body]
+        finally:
+            self.used, self.called = used, called
+
+    def fold_cond(self, x, bound):
+        clauses = []
+        for (p, e) in x[1:]:
+            p = self.fold(p, bound)
+            known, value = self.constant_value(p, bound)
+            if not known:
+                clauses.append([p, self.fold(e, bound)])
+            elif value:
+                if not clauses:          # always the first true test
+                    return self.fold(e, bound)
+                clauses.append([p, self.fold(e, bound)])
+                break
+            # clauses whose test is always false are left out
+        return ['cond'] + clauses
+
+    def fold_call(self, x, bound):
+        procedure = self.global_value(x[0], bound)
+        try:
+            foldable = procedure in FOLDABLE
+        except TypeError:       # unhashable
+            foldable = False
+        if not foldable:
+            self.called = True
+            return x
+        if not all(is_constant(arg) for arg in x[1:]):
+            return x
+        try:
+            value = procedure(*x[1:])
+        except Exception:       # such as a division by zero, left to run time
+            return x
+        self.rely_on(x[0])
+        return value
+
+
+def fold(x, env=pl.global_env):
+    '''Returns x with its constant parts replaced by their value'''
+    return Folder(x, env).fold(x)
@@ -0,0 +1,138 @@
+'''Lisp lists, made of cons cells, and their conversion to and from
+Python lists
+'''
+
+import itertools
+
+
+class ElementWise:
+    '''Arithmetic done element by element, as by +, * and - in petit_lisp,
+       so that it stays so where the jit replaces these by Python
+       operators.  my_math is imported when used, since it imports this
+       module.'''
+    __slots__ = ()
+
+    def __add__(self, other):
+        import my_math
+        return my_math.my_sum(self, other)
+
+    def __radd__(self, other):
+        import my_math
+        return my_math.my_sum(other, self)
+
+    def __mul__(self, other):
+        import my_math
+        return my_math.my_prod(self, other)
+
+    def __rmul__(self, other):
+        import my_math
+        return my_math.my_prod(other, self)
+
+    def __sub__(self, other):
+        import my_math
+        return my_math.my_sub(self, other)
+
+    def __rsub__(self, other):
+        import my_math
+        return my_math.my_sub(other, self)
+
+    def __neg__(self):
+        import my_math
+        return my_math.my_sub(self)
+
+
+class Pair(ElementWise):
+    '''A cons cell; lists are chains of Pairs ending with NIL, so that
+       taking their cdr, or adding an item in front, does not copy them.
+
+       Pairs are immutable; they can be iterated over, and compare equal
+       to Python lists with the same items, so that they can be given to
+       Python functions expecting a sequence.'''
+    __slots__ = ('car', 'cdr')
+    end = object()     # marks the end of the shortest list when comparing
+
+    def __init__(self, car, cdr):
+        self.car = car
+        self.cdr = cdr
+
+    def __iter__(self):
+        pair = self
+        while type(pair) is Pair:
+            yield pair.car
+            pair = pair.cdr
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return True
+
+    def __eq__(self, other):
+        if not isinstance(other, (Pair, Nil, list)):
+            return NotImplemented
+        end = Pair.end
+        for a, b in itertools.zip_longest(self, other, fillvalue=end):
+            if a is end or b is end or a != b:
+                return False
+        return True
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return '({})'.format(' '.join(repr(item) for item in self))
+
+    def __reduce__(self):
+        # pickled as a sequence, rather than as deeply nested Pairs
+        return (Pair.from_list, (list(self),))
+
+    @staticmethod
+    def from_list(items):
+        '''Converts a Python sequence into a list made of Pairs'''
+        lst = NIL
+        for item in reversed(items):
+            lst = Pair(item, lst)
+        return lst
+
+
+class Nil(ElementWise):
+    '''The empty list; its only instance is NIL'''
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def __eq__(self, other):
+        if not isinstance(other, (Pair, Nil, list)):
+            return NotImplemented
+        return len(other) == 0
+
+    def __hash__(self):
+        return hash(())
+
+    def __repr__(self):
+        return '()'
+
+    def __reduce__(self):
+        return 'NIL'      # unpickled as the same instance
+
+
+NIL = Nil()
+LIST_TYPES = (Pair, Nil, list)
+
+
+def to_lisp(x):
+    '''Converts Python lists, including nested ones, into lists of Pairs'''
+    if isinstance(x, list):
+        return Pair.from_list([to_lisp(item) for item in x])
+    return x
+
+
+def to_python(x):
+    '''Converts lists of Pairs, including nested ones, into Python lists'''
+    if isinstance(x, (Pair, Nil)):
+        return [to_python(item) for item in x]
+    return x
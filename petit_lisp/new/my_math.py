@@ -1,12 +1,51 @@
+'''Arithmetic on numbers and on vectors of numbers
+
+The arguments of my_sum, my_prod and my_sub, bound to +, * and - in
+default_language.lisp, may be lists, array.array (such as petit_lisp
+vectors), memoryviews of them or NumPy arrays as well as numbers.
+Vectors are then combined element by element, and numbers are combined
+with every element: (+ xs ys), (* 2 xs).  The result is of the type of
+the first vector.
+
+When NumPy is installed, NumPy and array.array arrays are combined by
+NumPy; otherwise, and for lists, by map() with the functions of the
+operator module, so that the loop itself runs in C.  Either way, integer
+items are combined as Python ints: a result too large for the integer
+type of the vector gives a vector of floats rather than wrapping around.
+'''
+import array
+import functools
+import itertools
+import operator
+
+from lists import Pair, Nil
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VECTOR_TYPES = (Pair, Nil, list, tuple, array.array, memoryview)
+BUFFER_TYPES = (array.array, memoryview)
+if numpy is not None:
+    VECTOR_TYPES += (numpy.ndarray,)
+    BUFFER_TYPES += (numpy.ndarray,)
+
+
 def my_sum(*args):
     '''Returns the sum of the supplied arguments'''
-    return sum(arg for arg in args)
+    for arg in args:
+        if isinstance(arg, VECTOR_TYPES):
+            return elementwise(operator.add, args)
+    return sum(args)
 
 
 def my_prod(*args):
     '''Returns the product of the supplied arguments'''
     ans = 1
     for arg in args:
+        if isinstance(arg, VECTOR_TYPES):
+            return elementwise(operator.mul, args)
         ans *= arg
     return ans
 
@@ -14,6 +53,140 @@ def my_prod(*args):
 def my_sub(a, b=None):
     '''Subraction or negation: (- a b) returns a-b; (- a) returns -a'''
     if b is None:
+        if isinstance(a, VECTOR_TYPES):
+            return elementwise(operator.neg, [a])
         return -a
+    elif isinstance(a, VECTOR_TYPES) or isinstance(b, VECTOR_TYPES):
+        return elementwise(operator.sub, [a, b])
     else:
         return a - b
+
+
+def sum_items(vector):
+    '''Usage: (sum xs) ==> the sum of the items of xs'''
+    if numpy is not None and isinstance(vector, BUFFER_TYPES):
+        items = to_numpy(vector)
+        if fits(items.dtype, lambda: items.astype(float).sum()):
+            return items.sum().item()
+    return sum(vector)
+
+
+def dot(a, b):
+    '''Usage: (dot xs ys) ==> the sum of the products of the items of xs and ys'''
+    check_lengths([a, b])
+    if (numpy is not None and isinstance(a, BUFFER_TYPES)
+            and isinstance(b, BUFFER_TYPES)):
+        xs, ys = to_numpy(a), to_numpy(b)
+        result = numpy.dot(xs, ys)
+        if fits(result.dtype, lambda: numpy.dot(xs.astype(float), ys.astype(float))):
+            return result.item()
+    return sum(map(operator.mul, a, b))
+
+
+def fits(dtype, estimate):
+    '''False if a NumPy integer sum of the given dtype may have wrapped
+       around, given a function returning an estimate of it as a float'''
+    return dtype.kind not in 'iu' or abs(estimate()) < 2.0 ** 62
+
+
+def check_lengths(vectors):
+    lengths = {len(vector) for vector in vectors}
+    if len(lengths) > 1:
+        raise ValueError("vectors of different lengths: {}".format(sorted(lengths)))
+
+
+def elementwise(op, args):
+    '''Returns the vector obtained by applying op, a unary or binary
+       function, to the items of the vectors in args in turn'''
+    vectors = [arg for arg in args if isinstance(arg, VECTOR_TYPES)]
+    check_lengths(vectors)
+    if numpy is not None and any(isinstance(v, BUFFER_TYPES) for v in vectors):
+        return from_numpy(numpy_elementwise(op, args), vectors[0])
+    if len(args) == 1:
+        return convert(map(op, args[0]), args[0])
+    result = args[0]
+    for arg in args[1:]:
+        result = list(combine(op, result, arg))
+    return convert(result, vectors[0])
+
+
+def numpy_elementwise(op, args):
+    '''Returns the NumPy array obtained by applying op to args; where
+       NumPy integers would wrap around, the items are computed exactly
+       and made floats if they do not fit.'''
+    operands = [to_numpy(arg) if isinstance(arg, VECTOR_TYPES) else arg
+                for arg in args]
+    try:
+        result = apply(op, operands)
+        if result.dtype.kind not in 'iu':
+            return result
+        info = numpy.iinfo(result.dtype)
+        estimate = apply(op, [astype(arg, float) for arg in operands])
+        if not ((estimate >= info.max) | (estimate <= info.min)).any():
+            return result
+    except OverflowError:      # a Python int too large for the array's type
+        info = numpy.iinfo(numpy.int64)
+    exact = apply(op, [astype(arg, object) for arg in operands])
+    if all(info.min <= item <= info.max for item in exact):
+        return exact.astype(info.dtype)
+    return exact.astype(float)
+
+
+def apply(op, operands):
+    if len(operands) == 1:       # reduce would not call op
+        return op(operands[0])
+    return functools.reduce(op, operands)
+
+
+def astype(arg, dtype):
+    if isinstance(arg, numpy.ndarray):
+        return arg.astype(dtype)
+    return arg
+
+
+def combine(op, a, b):
+    '''Iterates over op(x, y) for the items x and y of a and b, which
+       are vectors of the same length, or a number and a vector'''
+    if not isinstance(a, VECTOR_TYPES):
+        a = itertools.repeat(a)
+    if not isinstance(b, VECTOR_TYPES):
+        b = itertools.repeat(b)
+    return map(op, a, b)
+
+
+def convert(items, like):
+    '''Returns the items as a vector of the same type as like'''
+    if isinstance(like, memoryview):     # a slice of a vector
+        like = like.obj
+    if isinstance(like, (Pair, Nil)):
+        return Pair.from_list(list(items))
+    elif isinstance(like, array.array):
+        items = list(items)
+        try:
+            return type(like)(like.typecode, items)
+        except (TypeError, OverflowError):     # such as floats from integers
+            return type(like)('d', items)
+    elif isinstance(like, tuple):
+        return tuple(items)
+    return list(items)
+
+
+def to_numpy(vector):
+    if isinstance(vector, numpy.ndarray):
+        return vector
+    elif isinstance(vector, array.array):
+        return numpy.frombuffer(vector, dtype=vector.typecode)
+    elif isinstance(vector, memoryview):
+        return numpy.frombuffer(vector, dtype=vector.format)
+    return numpy.array(list(vector))
+
+
+def from_numpy(result, like):
+    '''Returns a NumPy array as a vector of the same type as like'''
+    if isinstance(like, memoryview):
+        like = like.obj
+    if isinstance(like, numpy.ndarray):
+        return result
+    elif isinstance(like, array.array) and result.dtype.char in array.typecodes:
+        return type(like)(result.dtype.char, result.tobytes())
+    return convert(result.tolist(), like)
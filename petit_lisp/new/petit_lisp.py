@@ -1,15 +1,34 @@
 '''New class based version
 '''
 
+import argparse
+import bisect
+import collections
+import functools
 import importlib
+import importlib.util
+import inspect
+import io
+import itertools
 import operator
+import os
+import pickle
 import re
 import traceback
 import sys
+import types
+import weakref
+
+import prelude
+import vectors
+from lists import Pair, Nil, NIL, LIST_TYPES, to_lisp, to_python
 
 
 exit.__doc__ = "Quits the repl."
 
+CACHE_TAG = "petit-4"    # to change when the forms produced by Parser change
+CHUNK_SIZE = 1 << 16     # characters read at a time from a program file
+
 
 class Lisp:
     '''Grouping some basic lisp procedures into logical unit
@@ -30,22 +49,44 @@ class Lisp:
     @staticmethod
     def is_atom(atom):
         '''Usage: (atom? expr) ==> true if expr is not a list'''
-        return not isinstance(atom, list)
+        return not isinstance(atom, LIST_TYPES)
 
     @staticmethod
     def are_equal(val1, val2):
         '''Usage: (eq? expr1 expr2) ==> true if both are atoms and equal'''
-        return (not isinstance(val1, list)) and (val1 == val2)
+        return (not isinstance(val1, LIST_TYPES) and val1 == val2
+                and isinstance(val1, String) == isinstance(val2, String))
 
     @staticmethod
-    def car(*expr):
+    def car(lst):
         '''Usage: (car (exp1 exp2 exp3 ...)) ==> exp1'''
-        return expr[0][0]
+        if type(lst) is Pair:
+            return lst.car
+        return lst[0]       # Python list, obtained from Python code
 
     @staticmethod
-    def cdr(*expr):
-        '''Usage: (car (exp1 exp2 exp3 ...)) ==> (exp2 exp3 ...)'''
-        return list(expr[0][1:])
+    def cdr(lst):
+        '''Usage: (cdr (exp1 exp2 exp3 ...)) ==> (exp2 exp3 ...)'''
+        if type(lst) is Pair:
+            return lst.cdr
+        if not lst:
+            raise IndexError("cdr of an empty list")
+        return Pair.from_list(lst).cdr     # converted once, by the first cdr
+
+    @staticmethod
+    def cons(head, tail):
+        '''Used for the special form (cons exp1 exp2); if exp2 is not a list,
+           it is the same as (cons exp1 (cons exp2 '()))'''
+        if type(tail) is Pair or tail is NIL:
+            return Pair(head, tail)
+        elif isinstance(tail, list):
+            return Pair(head, Pair.from_list(tail))
+        return Pair(head, Pair(tail, NIL))
+
+    @staticmethod
+    def is_null(lst):
+        '''Used for the special form (null? exp)'''
+        return lst is NIL or (type(lst) is list and not lst)
 
 
 class Python:
@@ -53,9 +94,14 @@ class Python:
 
     @staticmethod
     def load_module(module, env=None):
-        '''Usage (load-py 'module_name)'''
-        mod = importlib.import_module(module)
-        env.update(vars(mod))
+        '''Usage (load-py 'module_name)
+
+           Binds module_name to the module, imported when first used;
+           the names of the module are then found, when not defined in
+           the environment, as they are used: (sqrt 2) or math.sqrt.'''
+        if importlib.util.find_spec(module) is None:
+            raise ModuleNotFoundError("No module named {!r}".format(module))
+        env.load_module(LazyModule(module))
 
     @staticmethod
     def from_module_load(module, *names, env=None):
@@ -71,64 +117,287 @@ class Python:
         for name, name_as in names:
             env.update({name_as: getattr(mod, name)})
 
+    @staticmethod
+    def get_attribute(obj, name):
+        '''Usage: (py-get module_or_instance 'name) ==> its attribute name'''
+        return getattr(obj, name)
+
     @staticmethod
     def with_instance(inst, attr, *args):
-        '''Usage: (with-py-inst instance 'attribute OR method arg1 arg 2 ...)'''
+        '''Usage: (with-py-inst instance 'attribute OR method arg1 arg 2 ...)
+
+           Lists are given to Python as, and obtained from Python as,
+           Python lists converted from or to Lisp lists.'''
         if hasattr(inst, attr):
             attr = getattr(inst, attr)
             if callable(attr):
-                return attr(*args)
+                return to_lisp(attr(*[to_python(arg) for arg in args]))
             else:
-                return attr
+                return to_lisp(attr)
         else:
             print("{} has no attribute {}.".format(inst, attr))
 
+    @staticmethod
+    def method(inst, attr):
+        '''Usage: (py-method instance 'method) ==> a procedure calling the
+           method of instance, looked up once, with lists converted as by
+           with-py-inst'''
+        method = getattr(inst, attr)
+
+        def call_method(*args):
+            result = method(*python_args(args))
+            return to_lisp(result) if isinstance(result, list) else result
+        return functools.wraps(method)(call_method)
+
+
+def python_args(args):
+    '''Returns args, or a copy with its lists converted to Python lists'''
+    for arg in args:
+        if isinstance(arg, (Pair, Nil)):
+            return [to_python(arg) for arg in args]
+    return args
+
+
+class LazyModule:
+    '''A module loaded by load-py, imported when one of its attributes
+       is first needed'''
+
+    def __init__(self, name):
+        self.name = name
+        self._module = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            self._module = importlib.import_module(self.name)
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.module, attr)
+
+    def __reduce__(self):
+        return (LazyModule, (self.name,))
+
+    def __repr__(self):
+        if self._module is None:
+            return "<module {!r}, not imported yet>".format(self.name)
+        return repr(self._module)
+
+    def lookup(self, var):
+        '''Returns (True, value) if var is name, or name.attr..., for one
+           of the attributes of the module, and (False, None) otherwise'''
+        if var.startswith(self.name + '.'):
+            value = self.module
+            for attr in var[len(self.name) + 1:].split('.'):
+                if not hasattr(value, attr):
+                    return False, None
+                value = getattr(value, attr)
+            return True, value
+        elif hasattr(self.module, var):
+            return True, getattr(self.module, var)
+        return False, None
+
+
+class AttributeCache:
+    '''The attribute of a with-py-inst call site, (with-py-inst inst 'attr ...),
+       remembered for the type of the last instance it was used with.
+
+       A method defined by that type, such as the split method of str, is
+       then called with the instance as its first argument, without being
+       looked up again; any other attribute, or a method stored in the
+       instance itself, is looked up by with_instance each time.  A
+       method replaced in its class is not seen by call sites which
+       already found it.'''
+
+    METHOD_TYPES = (types.FunctionType, types.MethodDescriptorType)
+
+    def __init__(self, attr):
+        self.attr = attr
+        self.type = None
+        self.method = None
+        self.instance_dict = False   # instances may have their own attributes
+
+    def __call__(self, inst, *args):
+        if type(inst) is not self.type:
+            self.lookup(inst)
+        method = self.method
+        if method is None or (self.instance_dict and self.attr in inst.__dict__):
+            return Python.with_instance(inst, self.attr, *args)
+        result = method(inst, *python_args(args))
+        return to_lisp(result) if isinstance(result, list) else result
+
+    def lookup(self, inst):
+        self.type = type(inst)
+        self.instance_dict = hasattr(inst, '__dict__')
+        value = inspect.getattr_static(self.type, self.attr, None)
+        self.method = value if isinstance(value, self.METHOD_TYPES) else None
+
 
 class FileLoader:
-    """Execute a "lisp" program in a file"""
+    """Execute a "lisp" program in a file
 
-    def __init__(self, filename):
+       Each form is evaluated as soon as it has been read, from the file
+       or from its cache: a long program starts running at once, and only
+       the form being evaluated is held in memory.
+
+       In batch mode, independent forms are evaluated in parallel; see
+       batch.py."""
+
+    def __init__(self, filename, batch=False):
         print("    --> Loading and executing {}".format(filename))
 
-        with open(filename, "r") as f:
-            program = f.readlines()
-        rps = self.running_paren_sums(program)
-        full_line = ""
-        for ((linenumber, paren_sum), program_line) in zip(rps, program):
-            if ";" in program_line:
-                program_line = program_line.split(";")[0]
-            program_line = program_line.strip()
-            full_line += program_line + " "
-            if paren_sum == 0 and full_line.strip():
+        forms = self.read_forms(filename)
+        if batch:
+            import batch as batch_mode
+            evaluations = batch_mode.schedule(forms)
+        else:
+            evaluations = ((linenumber, column, form, functools.partial(evaluate, form))
+                           for linenumber, column, form in forms)
+        try:
+            for linenumber, column, form, get_value in evaluations:
                 try:
-                    val = evaluate(parse(full_line))
+                    val = get_value()
                     if val is not None:
                         print(val)
                 except Exception as e:
                     print("\n    An error occured in loading %s:" % filename)
-                    print("line {}:\n{}".format(linenumber, full_line))
+                    print("line {}, column {}:\n{}".format(
+                        linenumber, column, Printer().to_string(form)))
                     print('      {}: {}'.format(type(e).__name__, e))
                     break
-                full_line = ""
-
-    def running_paren_sums(self, program):
-        """
-        Map the lines in the list program to a list whose entries contain
-        a running sum of the per-line difference between the number of '('
-        parentheses and the number of ')' parentheses.
-        """
-        total = 0
-        rps = []
-        for linenumber, line in enumerate(program):
-            total += line.count("(")-line.count(")")
-            rps.append((linenumber, total))
-        return rps
+        except SyntaxError as e:     # found after the forms before it were run
+            print("\n    An error occured in loading %s:" % filename)
+            print('      {}: {}'.format(type(e).__name__, e))
+        finally:
+            evaluations.close()
+            forms.close()
+
+    def read_forms(self, filename):
+        '''Yields the (line, column, form) of each top-level form in a file,
+           parsed again only if the file has changed since it was cached'''
+        cache = ParseCache(filename)
+        forms = cache.load()
+        if forms is not None:
+            yield from forms
+            return
+        with open(filename, "r") as f:
+            parser = Parser()
+            yield from cache.save(parser.read_all(parser.scan_file(f)))
+
+
+class ParseCache:
+    '''Parsed forms of a file, stored in the __lispcache__ directory next
+       to it, similarly to Python's __pycache__.
+
+       The cache is used only if it was written for the same size and
+       modification time of the file, by a version of this module
+       producing the same parsed forms (see CACHE_TAG).  It holds the key
+       followed by one pickle per form, so that forms are written as they
+       are parsed and read back one at a time.'''
+
+    def __init__(self, filename):
+        directory, name = os.path.split(os.path.abspath(filename))
+        self.filename = filename
+        self.path = os.path.join(directory, "__lispcache__",
+                                 "{}.{}.pickle".format(name, CACHE_TAG))
+
+    def key(self):
+        stat = os.stat(self.filename)
+        return (CACHE_TAG, stat.st_size, stat.st_mtime_ns)
+
+    def load(self):
+        '''Returns an iterator over the cached forms, or None if they are
+           missing or stale'''
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return None
+        try:
+            key = pickle.load(f)
+        except Exception:     # unreadable or from another Python
+            key = None
+        if key != self.key():
+            f.close()
+            return None
+        return self.records(f)
+
+    def records(self, f):
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def save(self, forms):
+        '''Yields the forms, writing each of them to the cache on the way;
+           the cache is replaced only if all the forms have been read.
+           Failures, for example in a read-only directory, are silently
+           ignored, as they are for __pycache__.'''
+        temp = "{}.{}".format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            f = open(temp, "wb")
+        except OSError:
+            f = None
+        f = self.write(f, self.key())
+        complete = False
+        try:
+            for form in forms:
+                f = self.write(f, form)
+                yield form
+            complete = f is not None
+        finally:
+            if f is not None:
+                f.close()
+            try:
+                if complete:
+                    os.replace(temp, self.path)
+                else:
+                    os.remove(temp)
+            except OSError:
+                pass
+
+    def write(self, f, record):
+        '''Appends a record to the cache being written, if any; returns the
+           file, or None once writing to it has failed'''
+        if f is None:
+            return None
+        try:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            return f
+        except OSError:
+            f.close()
+            return None
+
+
+class String(str):
+    '''A string literal, written between double quotes in a program.
+
+       Symbols are represented by Python strings and evaluate to the value
+       they are bound to; a String evaluates to itself.'''
+    __slots__ = ()
+
+    escapes = {'n': '\n', 't': '\t', '"': '"', '\\': '\\'}
+
+    @classmethod
+    def from_token(cls, token):
+        '''Converts a token, including its enclosing double quotes, into a
+           String, replacing escape sequences such as \\" or \\n'''
+        return cls(re.sub(r'\\(.)', lambda m: cls.escapes.get(m.group(1), m.group()),
+                          token[1:-1], flags=re.DOTALL))
+
+    def to_token(self):
+        '''Converts back a String into a token'''
+        return '"{}"'.format(self.replace('\\', '\\\\').replace('"', '\\"')
+                             .replace('\n', '\\n').replace('\t', '\\t'))
 
 
 def display(s):
-    '''Prints a single string.  Strings are enclosed between double quotes
-       and do not allow escaped double quote characters'''
-    print(s[1:-1])  # strings are stored with enclosing double quote characters
+    '''Prints a single string.'''
+    print(s)
 
 
 def common_env(env):
@@ -153,14 +422,21 @@ def common_env(env):
         'not': operator.not_,
         'load': FileLoader,
         'DEBUG': False,
-        'nil': [],
+        'print-length': False,     # at most this number of items of a list is shown
+        'print-depth': False,      # lists nested deeper than this are shown as #
+        'print-shared': False,     # label lists appearing more than once
+        'nil': NIL,
         'print': display,
         'load-py': Python.load_module,
         'from-py-load': Python.from_module_load,
         'from-py-load-as': Python.from_module_load_variable_as,
         'with-py-inst': Python.with_instance,
+        'py-method': Python.method,
+        'py-get': Python.get_attribute,
         'set-docstring': Procedure.set_docstring
     })
+    env.update(prelude.builtins)
+    env.update(vectors.builtins)
     return env
 
 
@@ -173,7 +449,7 @@ class Procedure(object):
     def __call__(self, *args):
         if self.opt_param:
             args = self.pack_args(args)
-        return evaluate(self.body, Env(self.params, args, self.env))
+        return interpret(self.body, Env(self.params, args, self.env))
 
     def pack_args(self, args):
         '''ensures that any extra arguments are packed into a list'''
@@ -181,13 +457,15 @@ class Procedure(object):
             raise Exception("Not enough arguments supplied to procedure.")
         elif len(args) == self.opt_param:
             newargs = list(args)
-            newargs.append([])
+            newargs.append(NIL)
             return tuple(newargs)
         elif ((len(args) > self.opt_param + 1) or
-                (not isinstance(args[self.opt_param], list))):
+                (not isinstance(args[self.opt_param], LIST_TYPES))):
             newargs = [arg for arg in args[:self.opt_param]]
-            newargs.append(list(args[self.opt_param:]))
+            newargs.append(Pair.from_list(args[self.opt_param:]))
             return tuple(newargs)
+        elif isinstance(args[self.opt_param], list):
+            return tuple(args[:self.opt_param]) + (to_lisp(args[self.opt_param]),)
         else:
             return args
 
@@ -197,137 +475,1067 @@ class Procedure(object):
         obj.__doc__ = s
 
 
+class CompiledProcedure(Procedure):
+    '''A user-defined procedure whose body has already been analyzed.
+
+       Its arguments, followed by the nlocals variables defined in its body,
+       are stored in the slots of a Frame, as described by scope.
+
+       When pickled, for example to be sent to another process by pmap,
+       its code is left out and made again from its body.'''
+    def __init__(self, params, body, env, opt_param=False, code=None, nlocals=0,
+                 scope=None):
+        super().__init__(params, body, env, opt_param)
+        self.code = code
+        self.nlocals = nlocals
+        self.scope = scope
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['code']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.code = self.make_code()
+
+    def make_code(self):
+        '''Returns the code of the body, analyzed again'''
+        return analyzer.analyze(self.body, self.scope, tail=True)
+
+    def __call__(self, *args):
+        procedure = self
+        while True:
+            result = procedure.code(procedure.new_frame(args))
+            if type(result) is not TailCall:
+                return result
+            procedure, args = result.procedure, result.args
+
+    def new_frame(self, args):
+        '''Creates the Frame in which the body is evaluated for given arguments'''
+        if self.opt_param:
+            args = self.pack_args(args)
+        if len(args) != len(self.params):
+            raise TypeError("Procedure expects {} arguments, got {}.".format(
+                            len(self.params), len(args)))
+        values = list(args)
+        if self.nlocals:
+            values.extend([UNASSIGNED] * self.nlocals)
+        return Frame(values, self.env)
+
+
+class TailCall:
+    '''A call to a CompiledProcedure, in tail position, that remains
+       to be made'''
+    __slots__ = ('procedure', 'args')
+
+    def __init__(self, procedure, args):
+        self.procedure = procedure
+        self.args = args
+
+
 class Env(dict):
-    "An environment: a dict of {'var': val} pairs, with an outer Env."
+    """An environment: a dict of {'var': val} pairs, with an outer Env.
+
+       The names of the modules loaded in an Env by load-py are bound in
+       it the first time they are looked up there and not found."""
+
+    modules = ()       # LazyModules, most recently loaded last
 
     def __init__(self, params=(), args=(), outer=None):
         self.update(zip(params, args))
         self.outer = outer
 
+    def __missing__(self, var):
+        if self.modules and self.resolve(var):
+            return self[var]
+        raise KeyError(var)
+
+    def load_module(self, module):
+        self[module.name] = module
+        self.modules = [m for m in self.modules if m.name != module.name] + [module]
+
+    def resolve(self, var):
+        "Binds var if it is a name of one of the modules of this Env; True if so."
+        for module in reversed(self.modules):
+            found, value = module.lookup(var)
+            if found:
+                self[var] = value
+                return True
+        return False
+
     def find(self, var):
         "Find the innermost Env where var appears."
-        if var in self:
+        if var in self or (self.modules and self.resolve(var)):
             return self
         elif self.outer is not None:
             return self.outer.find(var)
         else:
             raise ValueError("{} is not defined".format(var))
 
+    def __reduce__(self):
+        if self is global_env:     # the global environment of the process
+            return 'global_env'
+        state = {'modules': self.modules} if self.modules else None
+        return (Env, ((), (), self.outer), state, None, iter(self.items()))
+
+
+class Frame:
+    '''The local environment of a CompiledProcedure call.
+
+       Variables are stored in the values list, at the slot computed by the
+       Analyzer's Scope; variables whose name is only known at run time,
+       such as those added by (load-py 'module) within a procedure body,
+       are stored in the extra Env, created only when needed.'''
+    __slots__ = ('values', 'outer', 'extra')
+
+    def __init__(self, values, outer):
+        self.values = values
+        self.outer = outer
+        self.extra = None
+
+    def __getitem__(self, var):
+        return self.find(var)[var]
+
+    def __setitem__(self, var, value):
+        if self.extra is None:
+            self.extra = Env()
+        self.extra[var] = value
+
+    def update(self, *args, **kwargs):
+        if self.extra is None:
+            self.extra = Env()
+        self.extra.update(*args, **kwargs)
+
+    def load_module(self, module):
+        if self.extra is None:
+            self.extra = Env()
+        self.extra.load_module(module)
+
+    def find(self, var):
+        "Find the innermost Frame or Env where var appears as a named variable."
+        if self.extra is not None and (var in self.extra or self.extra.resolve(var)):
+            return self.extra
+        return self.outer.find(var)
+
+
+class Scope:
+    '''Compile-time counterpart of a Frame: records the slot of each
+       variable bound by a lambda expression.'''
+
+    def __init__(self, params, definitions=(), outer=None):
+        self.slots = {}
+        for name in list(params) + list(definitions):
+            self.slots.setdefault(name, len(self.slots))
+        self.nparams = len(params)
+        self.outer = outer
+
+    def address(self, var):
+        '''Returns (depth, slot) for a lexically bound variable, where depth
+           is the number of Frames to go through, or None otherwise'''
+        depth, scope = 0, self
+        while scope is not None:
+            if var in scope.slots:
+                return depth, scope.slots[var]
+            scope = scope.outer
+            depth += 1
+        return None
+
+
+class Unassigned:
+    '''The type of UNASSIGNED, the value of local variables before their
+       definition'''
+    __slots__ = ()
+
+    def __reduce__(self):
+        return 'UNASSIGNED'     # unpickled as the same instance
+
+    def __repr__(self):
+        return '<unassigned>'
+
+
+UNASSIGNED = Unassigned()
+
 global_env = common_env(Env())
+BUILTIN_NAMES = frozenset(global_env)
 
 
-def evaluate(x, env=global_env):
-    "Evaluate an expression in an environment."
-    if isinstance(x, str):            # variable reference
-        return env.find(x)[x]
-    elif not isinstance(x, list):     # constant literal
-        return x
+ENV_RECEIVERS = {}    # code of a Python function: True if it takes an env argument
+ENV_RECEIVER_OBJECTS = weakref.WeakKeyDictionary()    # the same, for other callables
+
+
+def receives_env(procedure):
+    '''True if procedure is a Python function taking an env argument;
+       this is found once for each function definition, from its code,
+       and once for each other callable object'''
+    kind = type(procedure)
+    if kind is types.FunctionType:
+        code = procedure.__code__
+    elif kind is types.BuiltinFunctionType or isinstance(procedure, Procedure):
+        return False
+    elif kind is types.MethodType and type(procedure.__func__) is types.FunctionType:
+        code = procedure.__func__.__code__
+    else:
+        try:
+            return ENV_RECEIVER_OBJECTS[procedure]
+        except KeyError:
+            result = ENV_RECEIVER_OBJECTS[procedure] = takes_env(procedure)
+            return result
+        except TypeError:     # unhashable, or without weak references
+            return takes_env(procedure)
+    try:
+        return ENV_RECEIVERS[code]
+    except KeyError:
+        names = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+        result = ENV_RECEIVERS[code] = 'env' in names
+        return result
+
+
+def takes_env(procedure):
+    try:
+        return 'env' in inspect.signature(procedure).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def call(procedure, args, env):
+    '''Calls a procedure, supplying the environment to those that need it'''
+    if receives_env(procedure):
+        return procedure(*args, env=env)
+    return procedure(*args)
+
+
+def interpret(x, env=global_env):
+    '''Evaluate an expression in an environment by walking its parse tree.
+
+       Expressions in tail position, including the body of a Procedure
+       called in tail position, are evaluated by going through the loop
+       again rather than by a recursive call.'''
+    while True:
+        if isinstance(x, String):         # string literal
+            return x
+        elif isinstance(x, str):          # variable reference
+            return env.find(x)[x]
+        elif not isinstance(x, list):     # constant literal
+            return x
+
+        first = x[0]
+        if type(first) is not str:        # only symbols name special forms
+            first = None
+        if first == 'quote':              # (quote exp), or 'exp
+            (_, exp) = x
+            return to_lisp(exp)
+        elif first == 'cons':              # (cons exp1 exp2)
+            (_, exp1, exp2) = x
+            _x = interpret(exp2, env)
+            return Lisp.cons(interpret(exp1, env), _x)
+        elif first == 'define':            # (define var exp)
+            (_, var, exp) = x
+            env[var] = interpret(exp, env)
+            return None
+        elif first == 'define-memo':       # (define-memo var exp [max_size])
+            x = memo_definition(x)
+        elif first == 'profile':           # (profile exp)
+            (_, exp) = x
+            return profile(lambda: interpret(exp, env))
+        elif first == 'set!':              # (set! var exp)
+            (_, var, exp) = x
+            env.find(var)[var] = interpret(exp, env)
+            return None
+        elif first == 'lambda':            # (lambda (params*) body)
+            (_, params, body) = x
+            opt_param = False
+            if '.' in params:
+                opt_param = params.index('.')
+                params.pop(opt_param)
+            return Procedure(params, body, env, opt_param)
+        elif first == 'cond':              # (cond (p1 e1) ... (pn en))
+            for (p, e) in x[1:]:
+                if interpret(p, env):
+                    x = e
+                    break
+            else:
+                return None
+        elif first == 'if':                # (if test if_true other)
+            (_, test, if_true, other) = x
+            x = if_true if interpret(test, env) else other
+        elif first == 'begin':             # (begin exp* exp_last)
+            if len(x) == 1:
+                return None
+            for exp in x[1:-1]:
+                interpret(exp, env)
+            x = x[-1]
+        elif first == 'null?':             # (null? exp)
+            (_, exp) = x
+            return Lisp.is_null(interpret(exp, env))
+        elif first == 'and':               # (and exp*)
+            return all(interpret(exp, env) for exp in x[1:])
+        elif first == 'or':                # (or exp*)
+            return any(interpret(exp, env) for exp in x[1:])
+        else:                             # ("procedure" exp*)
+            exps = [interpret(exp, env) for exp in x]
+            procedure = exps.pop(0)
+            if type(procedure) is not Procedure:
+                return call(procedure, exps, env)
+            if procedure.opt_param:
+                exps = procedure.pack_args(exps)
+            x, env = procedure.body, Env(procedure.params, exps, procedure.env)
+
+
+def memo_definition(x):
+    '''Returns the define form equivalent to (define-memo var exp [max_size]),
+       that is (define var (memoize exp [max_size])), with memoize being
+       the builtin whatever the variable is bound to'''
+    (_, var, exp, *max_size) = x
+    return ['define', var, [prelude.memoize, exp] + max_size]
+
 
-    first = x[0]
-    if first == 'quote':              # (quote exp), or 'exp
+class Analyzer:
+    '''Converts a parsed expression into a Python closure taking an
+       environment as its only argument.
+
+       All the decisions that depend only on the shape of the expression,
+       such as recognizing special forms, are made once, during the analysis;
+       running the resulting closure, for example each time the body of
+       a Procedure is evaluated, only does the remaining work.
+
+       Variables bound by an enclosing lambda are found directly in the
+       slot of the relevant Frame, using the (depth, slot) address given
+       by the Scope in effect during the analysis; other variables are
+       looked up by name in the global environment.
+
+       A call to a CompiledProcedure in tail position is not made by the
+       closure: it returns a TailCall instead, which is carried out by the
+       loop in CompiledProcedure.__call__, so that iterative procedures
+       run without growing the Python stack.
+    '''
+
+    def __init__(self):
+        self.special_forms = {
+            'quote': self.analyze_quote,
+            'cons': self.analyze_cons,
+            'define': self.analyze_define,
+            'define-memo': self.analyze_define_memo,
+            'set!': self.analyze_set,
+            'lambda': self.analyze_lambda,
+            'cond': self.analyze_cond,
+            'if': self.analyze_if,
+            'begin': self.analyze_begin,
+            'null?': self.analyze_null,
+            'and': self.analyze_and,
+            'or': self.analyze_or,
+            'profile': self.analyze_profile
+        }
+        self.tail_forms = {'if', 'cond', 'begin'}
+
+    def analyze(self, x, scope=None, tail=False):
+        '''Converts an expression into a procedure of a single argument, env;
+           tail is true if the value of x is the value of a procedure body.'''
+        if isinstance(x, String):         # string literal
+            return lambda env: x
+        elif isinstance(x, str):          # variable reference
+            return self.analyze_variable(x, scope)
+        elif not isinstance(x, list):     # constant literal
+            return lambda env: x
+        first = x[0]
+        if type(first) is str and first in self.special_forms:
+            if first in self.tail_forms:
+                return self.special_forms[first](x, scope, tail)
+            return self.special_forms[first](x, scope)
+        return self.analyze_call(x, scope, tail)
+
+    def analyze_variable(self, var, scope):
+        address = scope.address(var) if scope is not None else None
+        if address is None:
+            return self.analyze_global(var)
+        depth, slot = address
+        if slot >= self.nparams(scope, depth):
+            return self.analyze_local_definition(var, depth, slot)
+        if depth == 0:
+            return lambda env: env.values[slot]
+        elif depth == 1:
+            return lambda env: env.outer.values[slot]
+
+        def ref(env):
+            for _ in range(depth):
+                env = env.outer
+            return env.values[slot]
+        return ref
+
+    def analyze_local_definition(self, var, depth, slot):
+        def ref(env):
+            for _ in range(depth):
+                env = env.outer
+            value = env.values[slot]
+            if value is UNASSIGNED:
+                raise ValueError("{} is not defined".format(var))
+            return value
+        return ref
+
+    def analyze_global(self, var):
+        def ref(env):
+            while type(env) is Frame:
+                if env.extra is not None and (var in env.extra or
+                                              env.extra.resolve(var)):
+                    return env.extra[var]
+                env = env.outer
+            if var in env:
+                return env[var]
+            return env.find(var)[var]
+        return ref
+
+    def nparams(self, scope, depth):
+        for _ in range(depth):
+            scope = scope.outer
+        return scope.nparams
+
+    def local_definitions(self, body):
+        '''Returns the variables defined in body, excluding those defined
+           within nested lambda expressions'''
+        names = []
+        if not isinstance(body, list) or not body:
+            return names
+        if type(body[0]) is str:
+            if body[0] in ('quote', 'lambda'):
+                return names
+            if body[0] == 'define' and len(body) == 3 and isinstance(body[1], str):
+                names.append(body[1])
+            elif body[0] == 'define-memo' and isinstance(body[1], str):
+                names.append(body[1])
+            body = body[1:]
+        for x in body:      # including the (test exp) clauses of cond
+            names.extend(self.local_definitions(x))
+        return names
+
+    def analyze_quote(self, x, scope):       # (quote exp), or 'exp
         (_, exp) = x
-        return exp
-    elif first == 'cons':              # (cons exp1 exp2)
+        exp = to_lisp(exp)
+        return lambda env: exp
+
+    def analyze_cons(self, x, scope):        # (cons exp1 exp2)
         (_, exp1, exp2) = x
-        _x = evaluate(exp2, env)
-        if not isinstance(_x, list):
-            _x = [_x]
-        return [evaluate(exp1, env)] + _x
-    elif first == 'define':            # (define var exp)
+        head, tail = self.analyze(exp1, scope), self.analyze(exp2, scope)
+
+        def cons(env):
+            _x = tail(env)
+            return Lisp.cons(head(env), _x)
+        return cons
+
+    def analyze_define(self, x, scope):      # (define var exp)
         (_, var, exp) = x
-        env[var] = evaluate(exp, env)
-    elif first == 'set!':              # (set! var exp)
+        value = self.analyze(exp, scope)
+        if scope is not None and var in scope.slots:
+            slot = scope.slots[var]
+
+            def define_local(env):
+                env.values[slot] = value(env)
+            return define_local
+
+        def define(env):
+            env[var] = value(env)
+        return define
+
+    def analyze_define_memo(self, x, scope):  # (define-memo var exp [max_size])
+        return self.analyze_define(memo_definition(x), scope)
+
+    def analyze_profile(self, x, scope):     # (profile exp)
+        (_, exp) = x
+        exp = self.analyze(exp, scope)
+        return lambda env: profile(lambda: exp(env))
+
+    def analyze_set(self, x, scope):         # (set! var exp)
         (_, var, exp) = x
-        env.find(var)[var] = evaluate(exp, env)
-    elif first == 'lambda':            # (lambda (params*) body)
+        value = self.analyze(exp, scope)
+        address = scope.address(var) if scope is not None else None
+        if address is not None:
+            depth, slot = address
+
+            def set_local(env):
+                val = value(env)
+                for _ in range(depth):
+                    env = env.outer
+                env.values[slot] = val
+            return set_local
+
+        def set_(env):
+            env.find(var)[var] = value(env)
+        return set_
+
+    def analyze_lambda(self, x, scope):      # (lambda (params*) body)
         (_, params, body) = x
+        params = list(params)
         opt_param = False
         if '.' in params:
             opt_param = params.index('.')
             params.pop(opt_param)
-        return Procedure(params, body, env, opt_param)
-    elif first == 'cond':              # (cond (p1 e1) ... (pn en))
-        for (p, e) in x[1:]:
-            if evaluate(p, env):
-                return evaluate(e, env)
-    elif first == 'if':                # (if test if_true other)
+        local_scope = Scope(params, self.local_definitions(body), scope)
+        code = self.analyze(body, local_scope, tail=True)
+        return self.make_procedure(params, body, opt_param, code, local_scope)
+
+    def make_procedure(self, params, body, opt_param, code, scope):
+        '''Returns the closure creating a procedure each time the lambda
+           expression is evaluated'''
+        nlocals = len(scope.slots) - scope.nparams
+        return lambda env: CompiledProcedure(params, body, env, opt_param,
+                                             code, nlocals, scope)
+
+    def analyze_cond(self, x, scope, tail):  # (cond (p1 e1) ... (pn en))
+        clauses = [(self.analyze(p, scope), self.analyze(e, scope, tail))
+                   for (p, e) in x[1:]]
+
+        def cond(env):
+            for (p, e) in clauses:
+                if p(env):
+                    return e(env)
+        return cond
+
+    def analyze_if(self, x, scope, tail):    # (if test if_true other)
         (_, test, if_true, other) = x
-        return evaluate((if_true if evaluate(test, env) else other), env)
-    elif first == 'null?':             # (null? exp)
+        test, if_true, other = (self.analyze(test, scope),
+                                self.analyze(if_true, scope, tail),
+                                self.analyze(other, scope, tail))
+        return lambda env: if_true(env) if test(env) else other(env)
+
+    def analyze_begin(self, x, scope, tail):  # (begin exp* exp_last)
+        if len(x) == 1:
+            return lambda env: None
+        exps = [self.analyze(exp, scope) for exp in x[1:-1]]
+        last = self.analyze(x[-1], scope, tail)
+
+        def begin(env):
+            for exp in exps:
+                exp(env)
+            return last(env)
+        return begin
+
+    def analyze_null(self, x, scope):        # (null? exp)
         (_, exp) = x
-        return evaluate(exp, env) == []
-    else:                             # ("procedure" exp*)
-        exps = [evaluate(exp, env) for exp in x]
-        procedure = exps.pop(0)
-        try:
-            return procedure(*exps, env=env)
-        except TypeError:
-            return procedure(*exps)
+        exp = self.analyze(exp, scope)
+        is_null = Lisp.is_null
+        return lambda env: is_null(exp(env))
+
+    def analyze_and(self, x, scope):         # (and exp*)
+        exps = [self.analyze(exp, scope) for exp in x[1:]]
+        return lambda env: all(exp(env) for exp in exps)
+
+    def analyze_or(self, x, scope):          # (or exp*)
+        exps = [self.analyze(exp, scope) for exp in x[1:]]
+        return lambda env: any(exp(env) for exp in exps)
+
+    def analyze_call(self, x, scope, tail):  # ("procedure" exp*)
+        procedure = self.analyze(x[0], scope)
+        args = [self.analyze(exp, scope) for exp in x[1:]]
+        if is_attribute_call(x, scope):
+            return self.analyze_attribute_call(x, procedure, args)
+        if tail:
+            return self.analyze_tail_call(procedure, args)
+        # calls with up to 3 arguments evaluate them in the closure itself,
+        # so that each level of a recursion uses fewer Python frames
+        if len(args) == 0:
+            def call0(env):
+                proc = procedure(env)
+                if receives_env(proc):
+                    return proc(env=env)
+                return proc()
+            return call0
+        elif len(args) == 1:
+            (arg1,) = args
+
+            def call1(env):
+                proc = procedure(env)
+                if receives_env(proc):
+                    return proc(arg1(env), env=env)
+                return proc(arg1(env))
+            return call1
+        elif len(args) == 2:
+            (arg1, arg2) = args
+
+            def call2(env):
+                proc = procedure(env)
+                if receives_env(proc):
+                    return proc(arg1(env), arg2(env), env=env)
+                return proc(arg1(env), arg2(env))
+            return call2
+        elif len(args) == 3:
+            (arg1, arg2, arg3) = args
+
+            def call3(env):
+                proc = procedure(env)
+                if receives_env(proc):
+                    return proc(arg1(env), arg2(env), arg3(env), env=env)
+                return proc(arg1(env), arg2(env), arg3(env))
+            return call3
+        return lambda env: call(procedure(env), [arg(env) for arg in args], env)
+
+    def analyze_tail_call(self, procedure, args):
+        '''Like analyze_call, returning a TailCall for CompiledProcedures'''
+        if len(args) == 1:
+            (arg1,) = args
+
+            def tail_call1(env):
+                proc = procedure(env)
+                if isinstance(proc, CompiledProcedure):
+                    return TailCall(proc, [arg1(env)])
+                elif receives_env(proc):
+                    return proc(arg1(env), env=env)
+                return proc(arg1(env))
+            return tail_call1
+        elif len(args) == 2:
+            (arg1, arg2) = args
+
+            def tail_call2(env):
+                proc = procedure(env)
+                if isinstance(proc, CompiledProcedure):
+                    return TailCall(proc, [arg1(env), arg2(env)])
+                elif receives_env(proc):
+                    return proc(arg1(env), arg2(env), env=env)
+                return proc(arg1(env), arg2(env))
+            return tail_call2
+
+        def tail_call(env):
+            proc = procedure(env)
+            if isinstance(proc, CompiledProcedure):
+                return TailCall(proc, [arg(env) for arg in args])
+            return call(proc, [arg(env) for arg in args], env)
+        return tail_call
+
+    def analyze_attribute_call(self, x, procedure, args):
+        '''(with-py-inst inst 'attr exp*), with a cache of attr for this call
+           site, used as long as with-py-inst is bound to with_instance'''
+        inst, rest = args[0], args[2:]
+        cache = AttributeCache(x[2][1])
+
+        def attribute_call(env):
+            proc = procedure(env)
+            if proc is not Python.with_instance:
+                return call(proc, [arg(env) for arg in args], env)
+            return cache(inst(env), *[arg(env) for arg in rest])
+        return attribute_call
+
+
+def is_attribute_call(x, scope):
+    '''True if x is (with-py-inst inst 'attr exp*), with-py-inst being a
+       global variable'''
+    return (len(x) >= 3 and type(x[0]) is str and x[0] == 'with-py-inst'
+            and isinstance(x[2], list)
+            and len(x[2]) == 2 and x[2][0] == 'quote' and isinstance(x[2][1], str)
+            and (scope is None or scope.address('with-py-inst') is None))
+
+
+analyzer = Analyzer()
+analyze = analyzer.analyze
+
+
+def execute(x, env=global_env):
+    "Evaluate an expression by analyzing it first, then running the result."
+    return analyze(x)(env)
+
+
+def run_on_vm(x, env=global_env):
+    "Evaluate an expression by compiling it to bytecode run by the vm module."
+    import vm
+    return vm.execute(x, env)
+
+
+def run_jit(x, env=global_env):
+    '''Evaluate an expression like execute, except that procedures called
+       often are translated into Python functions by the transpiler module.'''
+    import transpiler
+    return transpiler.execute(x, env)
+
+
+engines = {
+    'compile': execute,     # default
+    'interpret': interpret,  # original tree-walker, kept for comparison
+    'vm': run_on_vm,
+    'jit': run_jit
+}
+engine = execute
+optimize = None      # pass applied to expressions before they are evaluated
+profiling = None     # the active profiler.Profiler, if any
+
+
+def set_engine(name):
+    '''Selects the procedure used by evaluate: "compile", "interpret",
+       "vm" or "jit"'''
+    global engine
+    engine = engines[name]
+
+
+def set_folding(enabled):
+    '''Turns constant folding (see folding.py) on or off'''
+    global optimize
+    if enabled:
+        import folding
+        optimize = folding.fold
+    else:
+        optimize = None
+
+
+def evaluate(x, env=global_env):
+    "Evaluate an expression in an environment."
+    if optimize is not None:
+        x = optimize(x, env)
+    if profiling is not None:
+        profiling.instrument()
+    return engine(x, env)
+
+
+def profile(thunk):
+    '''Used for the special form (profile exp): returns the value of
+       thunk(), printing how long the procedures it called took'''
+    if profiling is not None:        # already within (profile ...)
+        return thunk()
+    import profiler
+    return profiler.profile(thunk)
+
+
+Token = collections.namedtuple('Token', 'value line column')
 
 
 class Parser:
     "Parse a Lisp expression from a string"
     def __init__(self):
-        self.regex = re.compile('"(?:[^"])*"')
+        self.scanner = re.compile(r'''
+              (?P<space>\s+)
+            | (?P<comment>;[^\n]*)
+            | (?P<token>\#\(|[()']|"(?:[^"\\]|\\.)*"|[^\s()'";]+)
+            | (?P<error>.)              # unterminated string
+            ''', re.VERBOSE)
 
     def parse(self, s):
         "Parse a Lisp expression from a string."
-        return self.convert_to_list(self.tokenize(s))
-
-    def convert_to_list(self, tokens):
-        "Converts a sequence of tokens into a list"
-        if len(tokens) == 0:
-            raise SyntaxError('convert_to_list: unexpected EOF while reading')
-        token = tokens.pop(0)
-        if '(' == token:
-            lst = []
-            while tokens[0] != ')':
-                lst.append(self.convert_to_list(tokens))
-            tokens.pop(0)   # pop off ')'
-            return lst
-        elif ')' == token:
-            raise SyntaxError('convert_to_list: unexpected )')
-        elif "'" == token:
-            return ['quote', self.convert_to_list(tokens)]
-        else:
-            return self.atomize(token)
+        return self.read(self.scan(s))
+
+    def read_all(self, tokens):
+        '''Yields the line, the column and the expression for each of the
+           expressions read from an iterator of tokens, as soon as the
+           tokens of each one have been read'''
+        tokens = iter(tokens)
+        for token in tokens:
+            yield token.line, token.column, self.read(itertools.chain([token], tokens))
+
+    def read(self, tokens):
+        '''Reads a single expression from an iterator of tokens, consuming
+           only the tokens that are needed, and returns it as a list'''
+        stack = []       # lists being built, and pending quotes
+        for token in tokens:
+            value = token.value
+            if '(' == value:
+                stack.append([])
+                continue
+            elif "'" == value:
+                stack.append(QUOTE)
+                continue
+            elif '#(' == value:
+                stack.extend([VECTOR, []])
+                continue
+            elif ')' == value:
+                if not stack or stack[-1] is QUOTE:
+                    raise SyntaxError('read: unexpected ) at line {}, column {}'
+                                      .format(token.line, token.column))
+                exp = stack.pop()
+                if stack and stack[-1] is VECTOR:
+                    stack.pop()
+                    exp = self.make_vector(exp, token)
+            elif value.startswith('"'):
+                exp = String.from_token(value)
+            else:
+                exp = self.atomize(value)
+            while stack and stack[-1] is QUOTE:
+                stack.pop()
+                exp = ['quote', exp]
+            if not stack:
+                return exp
+            stack[-1].append(exp)
+        raise SyntaxError('read: unexpected EOF while reading')
+
+    def make_vector(self, items, token):
+        try:
+            return vectors.Vector.from_items(items)
+        except TypeError:
+            raise SyntaxError('read: vector items must be numbers, in the vector '
+                              'ending at line {}, column {}'
+                              .format(token.line, token.column)) from None
 
     def atomize(self, token):
-        "Converts individual tokens to numbers if possible"
-        for conversion in [int, float, complex]:
+        '''Converts individual tokens to numbers if possible; other tokens
+           are symbols, interned so that equal names are the same object.
+           Only a token starting like a number is given to the conversions
+           below: it is an int most of the time, checked by a regex rather
+           than by catching exceptions.'''
+        if not NUMBER_START.match(token):
+            return sys.intern(token)
+        if INTEGER.match(token):
+            return int(token)
+        for conversion in [float, complex]:
             try:
                 return conversion(token.replace('i', 'j'))   # Python uses j instead
             except ValueError:                               # of i for sqrt(-1)
                 pass
-        return token
+        return sys.intern(token)
 
     def tokenize(self, s):
         "Convert a string into a list of tokens."
-        if '"' in s:
-            s = self.replace_strings(s)
-        return s.replace("(", " ( ").replace(")", " ) ").replace("'", " ' ").split()
-
-    def replace_strings(self, s):                       # noqa
-        '''replace double quoted strings by # followed by their Python id
-           and stores the correspondance in the global environment
-
-           Does not make allowance for escaped double quote (\") character.'''
-        quoted_strings = re.findall(self.regex, s)
-        for s_ in quoted_strings:
-            symbol = "#{}".format(id(s_))
-            s = s.replace(s_, symbol)
-            global_env[symbol] = s_
-        return s
+        return [token.value for token in self.scan(s)]
+
+    def scan(self, s):
+        '''Yields the tokens found in a string, in a single pass, together
+           with their position; comments are skipped.'''
+        return self.scan_chunks([s])
+
+    def scan_file(self, f, chunk_size=CHUNK_SIZE):
+        '''Yields the tokens of an open file, read chunk_size characters
+           at a time.'''
+        return self.scan_chunks(iter(lambda: f.read(chunk_size), ''))
+
+    def scan_chunks(self, chunks):
+        '''Yields the tokens found in consecutive pieces of a text; the
+           end of a piece may be in the middle of a token, which is then
+           completed by the next pieces.'''
+        buffer = ''
+        line, line_start = 1, 0   # line_start: offset of the line in buffer
+        for chunk in itertools.chain(chunks, [None]):
+            at_end = chunk is None
+            if not at_end:
+                buffer += chunk
+            done = 0
+            for match in self.scanner.finditer(buffer):
+                kind = match.lastgroup
+                if not at_end and (kind == 'error' or match.end() == len(buffer)):
+                    break         # may go on in the next chunk
+                if kind == 'token':
+                    yield Token(match.group(), line, match.start() - line_start + 1)
+                elif kind == 'error':
+                    raise SyntaxError('scan: unterminated string at line {}, column {}'
+                                      .format(line, match.start() - line_start + 1))
+                if kind != 'comment':
+                    newlines = match.group().count('\n')
+                    if newlines:
+                        line += newlines
+                        line_start = match.start() + match.group().rindex('\n') + 1
+                done = match.end()
+            buffer = buffer[done:]
+            line_start -= done
+
+
+QUOTE = object()   # marks a pending quote while reading
+VECTOR = object()  # marks a list read as the items of a vector
+
+NUMBER_START = re.compile(r'[+-]?\.?\d')    # symbols such as i or nan are not numbers
+INTEGER = re.compile(r'[+-]?\d(?:_?\d)*\Z')
 
 parse = Parser().parse
 
 
+class SymbolIndex:
+    '''The names defined in an environment, sorted, for help and dir.
+
+       Names are found by prefix with a binary search, or by substring;
+       the sorted list is only made again when the number of names of
+       the environment has changed.'''
+
+    def __init__(self, env):
+        self.env = env
+        self.size = None
+        self.sorted_names = []
+
+    def names(self):
+        if len(self.env) != self.size:
+            self.size = len(self.env)
+            self.sorted_names = sorted(name for name in self.env
+                                       if not name.startswith('__'))
+        return self.sorted_names
+
+    def with_prefix(self, prefix):
+        names = self.names()
+        start = bisect.bisect_left(names, prefix)
+        return list(itertools.takewhile(lambda name: name.startswith(prefix),
+                                        names[start:]))
+
+    def containing(self, text):
+        return [name for name in self.names() if text in name]
+
+    def user_defined(self):
+        return [name for name in self.names() if name not in BUILTIN_NAMES]
+
+    def builtins(self):
+        return [name for name in self.names() if name in BUILTIN_NAMES]
+
+
+END = object()     # marks the end of the items of a list while writing it
+TAIL = object()    # marks a labelled Pair within a list while writing it
+PLAIN_TYPES = (int, float, str)     # written as str() writes them
+WRITTEN_AS_LISTS = (Pair, list) + vectors.VECTOR_TYPES
+
+
+class Printer:
+    '''Writes values as petit_lisp expressions to a stream.
+
+       Lists are written without recursion, and the text is written
+       CHUNK pieces at a time, so that very long or deeply nested lists
+       can be shown.  At most length items of a list are written,
+       followed by ..., and lists nested more than depth levels deep are
+       written as #; None means no limit.
+
+       A list found within itself, as Python code can make one, is
+       written with a label: #0=(1 . #0#); if shared is true, so are the
+       lists and tails of lists found more than once.'''
+
+    CHUNK = 4096        # number of pieces of text joined for each write
+
+    def __init__(self, length=None, depth=None, shared=False):
+        self.length, self.depth, self.shared = length, depth, shared
+
+    @classmethod
+    def from_env(cls, env):
+        '''The Printer set by print-length, print-depth and print-shared'''
+        def limit(name):
+            value = env.get(name)
+            return value if type(value) is int else None
+        return cls(limit('print-length'), limit('print-depth'),
+                   env.get('print-shared') is True)
+
+    def to_string(self, exp):
+        stream = io.StringIO()
+        self.write(exp, stream)
+        return stream.getvalue()
+
+    def write(self, exp, stream):
+        labels = self.find_labels(exp)
+        numbers = {}        # id of a labelled list: its label, once written
+        limit = sys.maxsize if self.length is None else self.length
+        pieces = []
+        frames = []         # [Pair or iterator, depth of items, count, is a Pair]
+        x, depth = exp, 1   # the next value to write
+        while x is not END:
+            if type(x) in PLAIN_TYPES:
+                pieces.append(str(x))
+            elif not isinstance(x, WRITTEN_AS_LISTS):
+                pieces.append(self.atom(x))
+            elif labels and id(x) in labels and id(x) in numbers:
+                pieces.append('#{}#'.format(numbers[id(x)]))
+            else:
+                if labels and id(x) in labels:
+                    numbers[id(x)] = len(numbers)
+                    pieces.append('#{}='.format(numbers[id(x)]))
+                if self.depth is not None and depth > self.depth:
+                    pieces.append('#')
+                elif type(x) is Pair:
+                    pieces.append('(')
+                    frames.append([x, depth + 1, 0, True])
+                else:
+                    pieces.append('(' if isinstance(x, list) else '#(')
+                    frames.append([iter(x), depth + 1, 0, False])
+
+            x = END
+            while frames and x is END:     # writes the items of the innermost list
+                frame = frames[-1]         # up to the next list, or its end
+                source, depth, count, chain = frame
+                while True:
+                    if len(pieces) >= self.CHUNK:
+                        stream.write(''.join(pieces))
+                        pieces.clear()
+                    if not chain:
+                        item = next(source, END)
+                    elif type(source) is not Pair:
+                        item = END
+                    elif count and labels and id(source) in labels:
+                        item = TAIL
+                    else:
+                        item, source = source.car, source.cdr
+                    if item is END:
+                        pieces.append(')')
+                        frames.pop()
+                        break
+                    elif count >= limit:
+                        pieces.append(' ...)')
+                        frames.pop()
+                        break
+                    elif item is TAIL:      # the rest of the list is labelled
+                        pieces.append(' . ')
+                        frame[0] = NIL
+                        x, depth = source, depth - 1
+                        break
+                    if count:
+                        pieces.append(' ')
+                    count += 1
+                    if type(item) in PLAIN_TYPES:
+                        pieces.append(str(item))
+                    else:
+                        frame[0], frame[2] = source, count
+                        x = item
+                        break
+        stream.write(''.join(pieces))
+
+    def find_labels(self, exp):
+        '''Returns the ids of the lists, and Pairs in them, to be labelled,
+           visiting them in the order in which they are written'''
+        labels, seen, path = set(), set(), set()
+        limit = sys.maxsize if self.length is None else self.length
+        stack = [(exp, 1)] if isinstance(exp, (Pair, list)) else []
+        while stack:
+            x, depth = stack.pop()
+            if depth is None:           # the end of the list whose ids are x
+                path.difference_update(x)
+                continue
+            elif id(x) in seen:
+                if self.shared or id(x) in path:
+                    labels.add(id(x))
+                continue
+            elif self.depth is not None and depth > self.depth:
+                continue
+            ids, items = [], []
+            if type(x) is Pair:
+                add, append, node = seen.add, ids.append, x
+                for _ in range(limit):
+                    if type(node) is not Pair:
+                        break
+                    key = id(node)
+                    if key in seen:     # a tail already visited
+                        if self.shared or key in path or key in ids:
+                            labels.add(key)
+                        break
+                    add(key)
+                    append(key)
+                    car = node.car
+                    if type(car) not in PLAIN_TYPES and isinstance(car, (Pair, list)):
+                        items.append(car)
+                    node = node.cdr
+            else:
+                seen.add(id(x))
+                ids.append(id(x))
+                items = [item for item in x[:self.length]
+                         if isinstance(item, (Pair, list))]
+            if items:
+                path.update(ids)
+                stack.append((ids, None))
+                stack.extend((item, depth + 1) for item in reversed(items))
+        return labels
+
+    @staticmethod
+    def atom(exp):
+        if exp is True:
+            return "#t"
+        elif exp is False:
+            return "#f"
+        elif exp is NIL:
+            return "()"
+        elif isinstance(exp, complex):
+            return str(exp).replace('j', 'i')[1:-1]  # remove () put by Python
+        elif isinstance(exp, String):
+            return exp.to_token()
+        return str(exp)
+
+
 class InteractiveInterpreter:
     '''A simple interpreter with built-in help'''
     def __init__(self):
         self.started = False
         self.prompt = 'repl> '
         self.prompt2 = ' ... '
+        self.page_size = 20     # number of variables shown at a time by help
+        self.index = SymbolIndex(global_env)
 
     def repl(self):
         "A read-eval-print loop."
@@ -340,7 +1548,8 @@ class InteractiveInterpreter:
             try:
                 val = evaluate(parse(inp))
                 if val is not None:
-                    print(self.to_string(val))
+                    self.write(val)
+                    print()
             except (KeyboardInterrupt, SystemExit):
                 print("\n   Goodbye!")
                 return
@@ -373,8 +1582,7 @@ class InteractiveInterpreter:
             else:
                 self.show_variables(help[1])
         elif inp.startswith("dir"):
-            print("\n{}\n".format([x for x in global_env.keys()
-                                    if not x.startswith("__")]))
+            print("\n{}\n".format(self.index.with_prefix(inp[3:].strip())))
 
     def start(self):
         '''starts the interpreter if not already running'''
@@ -389,23 +1597,18 @@ class InteractiveInterpreter:
 
     def to_string(self, exp):
         "Convert a Python object back into a Lisp-readable string."
-        if not isinstance(exp, list):
-            if exp is True:
-                return "#t"
-            elif exp is False:
-                return "#f"
-            elif isinstance(exp, complex):
-                return str(exp).replace('j', 'i')[1:-1]  # remove () put by Python
-            return str(exp)
-        else:
-            return '(' + ' '.join(self.to_string(s) for s in exp) + ')'
+        return Printer.from_env(global_env).to_string(exp)
+
+    def write(self, exp, stream=None):
+        "Writes a Python object as a Lisp-readable expression to a stream."
+        Printer.from_env(global_env).write(exp, stream or sys.stdout)
 
     def show_value(self, var, env):
         '''Displays the value of a variable in a given environment or dict'''
         val = env[var]
         if not isinstance(val, (int, float, complex, str)):
             if hasattr(val, '__doc__') and val.__doc__ is not None:
-                val = ' '.join(val.__doc__.split('\n')[:3])
+                val = ' '.join(val.__doc__.split('\n', 3)[:3])
         if isinstance(val, str):
             if len(val) > 75:
                 val = val[:75].strip() + "..."
@@ -418,29 +1621,76 @@ class InteractiveInterpreter:
         env = global_env
         if obj == "help":
             print("Usage:  help, help variable, help globals, "
-                   "help user-defined")
-        elif obj not in [None, "user-defined", "globals"]:
-            if obj not in env:
-                print("Unknown variable: ", obj)
-            else:
-                self.show_value(obj, env)
+                   "help user-defined, help prefix*, help *text*")
+            return
+        elif obj is None:
+            names = self.index.names()
+        elif obj == "user-defined":
+            names = self.index.user_defined()
+        elif obj == "globals":
+            names = self.index.builtins()
+        elif obj in env or env.resolve(obj):
+            self.show_value(obj, env)
+            print()
+            return
+        elif len(obj) > 2 and obj.startswith('*') and obj.endswith('*'):
+            names = self.index.containing(obj[1:-1])
+        elif obj.endswith('*'):
+            names = self.index.with_prefix(obj[:-1])
         else:
-            names = sorted(env.keys())
-            for var in names:
-                if var.startswith('__'):
-                    continue
-                if obj == "user-defined" and var in common_env(Env()):
-                    continue
-                elif obj == "globals" and var not in common_env(Env()):
-                    continue
-                self.show_value(var, env)
+            print("Unknown variable: ", obj)
+            return
+        self.show_pages(names, env)
         print()
 
+    def show_pages(self, names, env):
+        '''Shows the variables page_size at a time, asking before each page'''
+        for start in range(0, len(names), self.page_size):
+            if start:
+                answer = input("  -- {} more: Enter to go on, q to stop -- ".format(
+                    len(names) - start))
+                if answer.strip() == 'q':
+                    break
+            for var in names[start:start + self.page_size]:
+                self.show_value(var, env)
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        FileLoader(sys.argv[1])
+
+def main():
+    parser = argparse.ArgumentParser(description="petit_lisp interpreter")
+    parser.add_argument("filename", nargs="?", default="default_language.lisp")
+    parser.add_argument("--engine", choices=sorted(engines), default="compile",
+                        help="compile expressions to closures before running "
+                             "them (default), interpret their parse tree, "
+                             "compile them to bytecode run by a stack vm, or "
+                             "also translate procedures called often to Python")
+    parser.add_argument("--dump-py", action="store_true",
+                        help="with --engine jit, print the Python code "
+                             "generated for each translated procedure")
+    parser.add_argument("--batch", action="store_true",
+                        help="evaluate independent top-level forms of the "
+                             "file in parallel, before starting the repl")
+    parser.add_argument("--no-fold", action="store_true",
+                        help="do not replace calls of builtins with constant "
+                             "arguments by their value before evaluating them")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the number of calls and the time taken "
+                             "by each procedure while loading the file")
+    args = parser.parse_args()
+    set_engine(args.engine)
+    set_folding(not args.no_fold)
+    if args.dump_py:
+        import transpiler
+        transpiler.DUMP = True
+    if args.profile:
+        profile(lambda: FileLoader(args.filename, batch=args.batch))
     else:
-        FileLoader("default_language.lisp")
+        FileLoader(args.filename, batch=args.batch)
     interpreter = InteractiveInterpreter()
     interpreter.start()
+
+
+if __name__ == "__main__":
+    # Run from the imported module so that other modules, such as vm,
+    # share its global environment.
+    import petit_lisp
+    petit_lisp.main()
@@ -0,0 +1,235 @@
+'''Native versions of list procedures
+
+These used to be defined as recursive lambdas in default_language.lisp;
+here, the loops over the items of a list are done by Python.  They are
+added to the environment by common_env, under the names given in
+builtins.  and and or are special forms, so that they can stop
+evaluating their arguments as soon as their value is known.
+
+memoize wraps a procedure in a cache of its results, used by the
+define-memo special form.  pmap is map done by a pool of processes.
+Where processes can be started by forking the interpreter, they share
+its global environment as it was when pmap was called; elsewhere, the
+procedure is pickled, together with the global variables its body may
+use, and the worker processes add these variables to their own global
+environment.
+'''
+
+import collections
+import concurrent.futures
+import functools
+import math
+import multiprocessing
+import os
+import pickle
+
+from lists import Pair, Nil, NIL
+
+
+def append(*lsts):
+    '''Usage: (append lst1 lst2 ...) ==> a list with the items of all lists;
+       the last list is shared, not copied'''
+    if not lsts:
+        return NIL
+    items = []
+    for lst in lsts[:-1]:
+        items.extend(lst)
+    result = lsts[-1]
+    if isinstance(result, list):
+        result = Pair.from_list(result)
+    for item in reversed(items):
+        result = Pair(item, result)
+    return result
+
+
+def make_list(*items):
+    '''Usage: (list exp1 exp2 ...) ==> (exp1 exp2 ...)'''
+    return Pair.from_list(items)
+
+
+def last(lst):
+    '''Usage: (last (exp1 ... exp_last)) ==> exp_last'''
+    if type(lst) is not Pair:
+        return lst[-1]
+    while type(lst.cdr) is Pair:
+        lst = lst.cdr
+    return lst.car
+
+
+def add(x, y, *z):
+    '''Usage: (add x y ...) ==> the sum of all arguments'''
+    return sum(z, x + y)
+
+
+def length(lst):
+    '''Usage: (length lst) ==> the number of items in lst'''
+    return len(lst)
+
+
+def reverse(lst):
+    '''Usage: (reverse (exp1 exp2 ... exp_last)) ==> (exp_last ... exp2 exp1)'''
+    result = NIL
+    for item in lst:
+        result = Pair(item, result)
+    return result
+
+
+def lisp_map(proc, lst, *lsts):
+    '''Usage: (map proc lst1 lst2 ...) ==> list of the values of proc called
+       with the first items of all lists, then with the second items, ...'''
+    if lsts:
+        return Pair.from_list(list(map(proc, lst, *lsts)))
+    return Pair.from_list(list(map(proc, lst)))
+
+
+def lisp_filter(pred, lst):
+    '''Usage: (filter pred lst) ==> list of the items of lst for which
+       pred is true'''
+    return Pair.from_list(list(filter(pred, lst)))
+
+
+def lisp_reduce(proc, lst, *initial):
+    '''Usage: (reduce proc lst [initial]) ==> combines the items of lst,
+       from left to right, as (proc (proc initial exp1) exp2) ...'''
+    return functools.reduce(proc, lst, *initial)
+
+
+class Memoized:
+    # The docstring, shown by help, is made by the __doc__ property below.
+
+    def __init__(self, proc, max_size=1024):
+        self.proc = proc
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()   # least recently used first
+        self.hits = self.misses = 0
+        self.doc = getattr(proc, '__doc__', None)
+
+    def __call__(self, *args):
+        try:
+            key = tuple(map(hashable, args))
+            value = self.cache[key]
+        except TypeError:          # an argument which cannot be a key
+            return self.proc(*args)
+        except KeyError:
+            self.misses += 1
+            value = self.cache[key] = self.proc(*args)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            return value
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return value
+
+    @property
+    def __doc__(self):
+        stats = "memoized: {} hits, {} misses, {} of {} results cached".format(
+            self.hits, self.misses, len(self.cache), self.max_size)
+        if self.doc:
+            return stats + '\n' + self.doc
+        return stats
+
+    @__doc__.setter
+    def __doc__(self, doc):          # used by set-docstring
+        self.doc = doc
+
+
+def hashable(arg):
+    '''Returns a key for an argument, converting lists to tuples; like
+       those of functools.lru_cache(typed=True), keys include the type of
+       the argument, so that 1, 1.0 and #t, or the String "a" and the
+       symbol a, are different keys'''
+    if isinstance(arg, (Pair, Nil, list)):
+        return type(arg), tuple(map(hashable, arg))
+    hash(arg)          # raises TypeError if arg cannot be a key
+    return type(arg), arg
+
+
+def memoize(proc, max_size=1024):
+    '''Usage: (memoize proc [max_size]) ==> proc, remembering the results of
+       the last max_size calls; help shows how often they were reused'''
+    return Memoized(proc, max_size)
+
+
+def pmap(proc, lst, chunk_size=None):
+    '''Usage: (pmap proc lst [chunk_size]) ==> same as (map proc lst), with
+       proc called by several processes, each given chunk_size items at a time'''
+    items = list(lst)
+    workers = min(os.cpu_count() or 1, len(items))
+    if workers < 2:
+        return lisp_map(proc, items)
+    if chunk_size is None:
+        chunk_size = math.ceil(len(items) / (workers * 4))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context, global_values = multiprocessing.get_context('fork'), {}
+    else:
+        context, global_values = multiprocessing.get_context(), used_globals(proc)
+        try:
+            pickle.dumps((proc, global_values))
+        except Exception:            # such as a procedure using a module
+            return lisp_map(proc, items)
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=context, initializer=start_worker,
+            initargs=(proc, global_values)) as executor:
+        results = []
+        for chunk in executor.map(map_chunk, chunks):
+            results.extend(chunk)
+    return Pair.from_list(results)
+
+
+def used_globals(proc):
+    '''Returns the global variables that may be used when calling proc,
+       directly or by the procedures it calls'''
+    import petit_lisp
+    global_env = petit_lisp.global_env
+    found = {}
+    procedures = [proc]
+    while procedures:
+        body = getattr(procedures.pop(), 'body', None)
+        for name in symbols(body):
+            if name in global_env and name not in found:
+                found[name] = value = global_env[name]
+                if isinstance(value, petit_lisp.Procedure):
+                    procedures.append(value)
+    return found
+
+
+def symbols(x):
+    '''Yields the symbols in an expression, except quoted ones'''
+    if isinstance(x, list):
+        if x and type(x[0]) is str and x[0] == 'quote':
+            return
+        for exp in x:
+            yield from symbols(exp)
+    elif isinstance(x, str) and type(x) is str:     # not a String literal
+        yield x
+
+
+_procedure = None    # the procedure given to pmap, in a worker process
+
+
+def start_worker(proc, global_values):
+    global _procedure
+    _procedure = proc
+    if global_values:
+        import petit_lisp
+        petit_lisp.global_env.update(global_values)
+
+
+def map_chunk(items):
+    return [_procedure(item) for item in items]
+
+
+builtins = {
+    'append': append,
+    'list': make_list,
+    'last': last,
+    'add': add,
+    'length': length,
+    'reverse': reverse,
+    'map': lisp_map,
+    'filter': lisp_filter,
+    'reduce': lisp_reduce,
+    'pmap': pmap,
+    'memoize': memoize,
+}
@@ -0,0 +1,139 @@
+'''Per-procedure call counts and times for petit_lisp programs
+
+While a Profiler is active, the procedures bound to global variables are
+replaced by profiled versions, named after these variables, which record
+how often they are called, their cumulative time (including the calls
+they make) and their self time (excluding them).  New global procedures,
+such as those defined by the forms of a file, are replaced before each
+top-level form is evaluated.  The original procedures are put back when
+profiling ends, so that nothing is recorded, and nothing slowed down,
+the rest of the time.
+
+Profiled versions of procedures made by the analyzer, the vm or the jit
+are themselves CompiledProcedures, so that their calls in tail position
+still do not use up the Python stack; with the interpret engine, they do.
+
+usage: (profile expr) in a program or at the repl, or
+       python petit_lisp.py --profile program.lisp
+'''
+
+import functools
+import time
+
+import petit_lisp as pl
+
+
+class Stats:
+    '''What was recorded for a procedure'''
+    __slots__ = ('calls', 'cumulative', 'self_time', 'active')
+
+    def __init__(self):
+        self.calls = 0
+        self.cumulative = self.self_time = 0.0
+        self.active = 0          # calls which have not returned yet
+
+
+class ProfiledProcedure(pl.CompiledProcedure):
+    '''A CompiledProcedure whose code records its calls'''
+
+    def __init__(self, original, code):
+        pl.CompiledProcedure.__init__(self, original.params, original.body,
+                                      original.env, original.opt_param, code,
+                                      original.nlocals, original.scope)
+        self.original = original
+        self.__doc__ = original.__doc__
+
+
+class Profiler:
+    '''Records the calls of global procedures between start and stop'''
+
+    def __init__(self, env=pl.global_env):
+        self.env = env
+        self.stats = {}
+        self.stack = []          # time spent in the calls made by each call
+        self.originals = {}      # name: procedure replaced by a profiled one
+        self.profiled = {}       # id: profiled version
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        pl.profiling = self
+        self.instrument()
+
+    def stop(self):
+        pl.profiling = None
+        for name, original in self.originals.items():
+            if id(self.env.get(name)) in self.profiled:
+                self.env[name] = original
+        self.originals.clear()
+        self.profiled.clear()
+
+    def instrument(self):
+        '''Replaces the global procedures not profiled yet'''
+        for name, value in list(self.env.items()):
+            if (not callable(value) or isinstance(value, type)
+                    or id(value) in self.profiled):
+                continue
+            profiled = self.profile(name, value)
+            self.originals[name] = value
+            self.profiled[id(profiled)] = profiled
+            self.env[name] = profiled
+
+    def profile(self, name, procedure):
+        '''Returns a profiled version of procedure'''
+        if isinstance(procedure, pl.CompiledProcedure):
+            return ProfiledProcedure(procedure, self.timed(
+                name, lambda frame: procedure.code(frame)))
+        elif pl.receives_env(procedure):
+            timed = self.timed(name, lambda args, env: procedure(*args, env=env))
+
+            def profiled(*args, env=None):
+                return timed(args, env)
+            return functools.wraps(procedure)(profiled)
+        return functools.wraps(procedure)(self.timed(name, procedure))
+
+    def timed(self, name, function):
+        '''Returns a function recording the calls of function under name'''
+        stats = self.stats.setdefault(name, Stats())
+        stack = self.stack
+        perf_counter = time.perf_counter
+
+        def profiled(*args):
+            stats.active += 1
+            stack.append(0.0)
+            start = perf_counter()
+            try:
+                return function(*args)
+            finally:
+                elapsed = perf_counter() - start
+                stats.active -= 1
+                stats.calls += 1
+                stats.self_time += elapsed - stack.pop()
+                if not stats.active:          # not within a recursive call
+                    stats.cumulative += elapsed
+                if stack:
+                    stack[-1] += elapsed
+        return profiled
+
+    def report(self, limit=20):
+        '''Prints the procedures taking the most time, by self time'''
+        called = sorted(((stats.self_time, name, stats)
+                         for name, stats in self.stats.items() if stats.calls),
+                        key=lambda item: item[0], reverse=True)
+        print("{:>10} {:>12} {:>12}  procedure".format("calls", "cumulative", "self"))
+        for _, name, stats in called[:limit]:
+            print("{:>10} {:>11.4f}s {:>11.4f}s  {}".format(
+                stats.calls, stats.cumulative, stats.self_time, name))
+
+
+def profile(thunk, env=pl.global_env):
+    '''Returns the value of thunk(), printing the profile of the call'''
+    with Profiler(env) as profiler:
+        value = thunk()
+    profiler.report()
+    return value
@@ -1,6 +1,13 @@
 ''' usage: python test_petit.py
 '''
+import array
+import contextlib
+import io
 import mock
+import os
+import pickle
+import sys
+import tempfile
 import unittest
 import petit_lisp as pl
 
@@ -35,6 +42,47 @@ class TestParse(unittest.TestCase):
     def test_parse_two_levels(self):
         self.assertEqual(['*', ['+', 3, 4], ['-', 2, 1]], pl.parse(" (* ( + 3 4) (- 2 1))"))
 
+    def test_parse_quote(self):
+        self.assertEqual(['quote', ['a', ['quote', 'b']]], pl.parse("'(a 'b)"))
+
+    def test_parse_comment(self):
+        self.assertEqual(['+', 3, 4], pl.parse("(+ 3 ; (- 1 2)\n 4)"))
+
+    def test_token_positions(self):
+        tokens = list(pl.Parser().scan("(define x\n   (+ 1 2))"))
+        self.assertEqual(pl.Token('(', 2, 4), tokens[3])
+
+    def test_scan_chunks(self):
+        program = '(define s "a (b)\n ;c")  ; comment (\n(display \'(s 12.5))\n'
+        chunks = [program[i:i + 3] for i in range(0, len(program), 3)]
+        parser = pl.Parser()
+        self.assertEqual(list(parser.scan(program)), list(parser.scan_chunks(chunks)))
+        self.assertEqual([(1, 1), (3, 1)],
+                         [(line, column) for line, column, _ in
+                          parser.read_all(parser.scan_chunks(chunks))])
+
+    def test_atomize(self):
+        parser = pl.Parser()
+        self.assertEqual([12, -3, 1000, 2.5, -0.5, 1e3, 2j, 1 + 2j],
+                         [parser.atomize(t) for t in
+                          ["12", "-3", "1_000", "2.5", "-.5", "1e3", "2i", "1+2i"]])
+        self.assertIsInstance(parser.atomize("12"), int)
+        for symbol in ["define", "i", "nan", "-", "...", "1+", "+x"]:
+            self.assertEqual(symbol, parser.atomize(symbol))
+
+    def test_symbols_interned(self):
+        first, second = pl.parse("(long-name long-name)")
+        self.assertIs(first, second)
+
+    def test_parse_string(self):
+        self.assertEqual(['print', 'a (b) "c"\n'], pl.parse(r'(print "a (b) \"c\"\n")'))
+        self.assertIsInstance(pl.parse('"x"'), pl.String)
+
+    def test_syntax_errors(self):
+        self.assertRaises(SyntaxError, pl.parse, "(+ 3 4")
+        with self.assertRaisesRegex(SyntaxError, "line 2, column 3"):
+            pl.parse("\n  )")
+
 
 class TestEvaluate(unittest.TestCase):
     '''Evaluate expressions, using the parse function as a first step'''
@@ -109,6 +157,193 @@ class TestEvaluate(unittest.TestCase):
         from math import pi
         self.assertEqual(pi, pl.evaluate(pl.parse("(mul_pi 1)")))
 
+    def test_string(self):
+        self.assertEqual("a b", pl.evaluate(pl.parse('"a b"')))
+        repl = pl.InteractiveInterpreter()
+        self.assertEqual(r'"say \"hi\""', repl.to_string(pl.parse(r'"say \"hi\""')))
+
+    def test_string_not_symbol(self):
+        self.assertFalse(pl.evaluate(pl.parse('(eq? "define" \'define)')))
+        self.assertTrue(pl.evaluate(pl.parse('(eq? "define" "define")')))
+        self.assertRaises(TypeError, pl.evaluate, pl.parse('("quote" 1)'))
+        pl.evaluate(pl.parse('(define str-head (lambda (x) ("if" x 1 2)))'))
+        self.assertRaises(TypeError, pl.evaluate, pl.parse('(str-head #t)'))
+
+    def test_strings_not_stored_in_global_env(self):
+        pl.evaluate(pl.parse('(define s "some text")'))
+        size = len(pl.global_env)
+        for _ in range(10):
+            pl.evaluate(pl.parse('(define s "some other text")'))
+        self.assertEqual(size, len(pl.global_env))
+
+
+class TestHelp(unittest.TestCase):
+    '''help and dir, using the SymbolIndex of the repl'''
+
+    def setUp(self):
+        self.repl = pl.InteractiveInterpreter()
+        for i in range(30):
+            pl.global_env['help-test-{:02}'.format(i)] = i
+
+    def test_index(self):
+        index = self.repl.index
+        self.assertEqual(['help-test-00', 'help-test-01'],
+                         index.with_prefix('help-test-0')[:2])
+        self.assertEqual(['help-test-29'], index.containing('st-29'))
+        self.assertIn('help-test-05', index.user_defined())
+        self.assertNotIn('car', index.user_defined())
+        self.assertIn('car', index.builtins())
+        self.assertNotIn('help-test-05', index.builtins())
+        pl.global_env['help-test-new'] = 0
+        self.assertIn('help-test-new', index.with_prefix('help-test'))
+
+    @mock.patch('builtins.input', return_value='q')
+    def test_pages(self, mock_input):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.repl.show_variables('help-test*')
+        self.assertEqual(1, mock_input.call_count)
+        self.assertIn('help-test-19: 19', output.getvalue())
+        self.assertNotIn('help-test-20', output.getvalue())
+
+    @mock.patch('builtins.input', return_value='')
+    def test_search(self, mock_input):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.repl.show_variables('*est-2*')
+            self.repl.show_variables('*')
+        self.assertEqual(0, mock_input.call_count)
+        self.assertIn('help-test-29: 29', output.getvalue())
+        self.assertNotIn('help-test-19', output.getvalue())
+        self.assertIn('  *: ', output.getvalue())
+
+
+class TestParseCache(unittest.TestCase):
+    '''Ensures that files are not parsed again unless they changed'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "cached.lisp")
+        self.write("(define cached 1)")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, program):
+        with open(self.filename, "w") as f:
+            f.write(program)
+
+    def test_cached(self):
+        pl.FileLoader(self.filename)
+        self.assertTrue(os.listdir(os.path.join(self.directory.name, "__lispcache__")))
+        with mock.patch.object(pl.Parser, 'read_all', side_effect=AssertionError):
+            pl.FileLoader(self.filename)
+        self.assertEqual(1, pl.evaluate(pl.parse("cached")))
+
+    def test_forms_run_as_read(self):
+        self.write("(define early 5)\n(define late 6")
+        pl.FileLoader(self.filename)
+        self.assertEqual(5, pl.evaluate(pl.parse("early")))
+        self.assertFalse(os.listdir(os.path.join(self.directory.name, "__lispcache__")))
+
+    def test_file_changed(self):
+        pl.FileLoader(self.filename)
+        self.write("(define cached 22)")
+        pl.FileLoader(self.filename)
+        self.assertEqual(22, pl.evaluate(pl.parse("cached")))
+
+    def test_error_report(self):
+        self.write('(define ok 1)\n  (define e (/ 1 0) "a b")')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            pl.FileLoader(self.filename)
+        self.assertIn('line 2, column 3:\n(define e (/ 1 0) "a b")\n',
+                      output.getvalue())
+
+
+class TestBatch(unittest.TestCase):
+    '''Ensures that forms evaluated in parallel give the same results as
+       forms evaluated in turn'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "batch.lisp")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_free_variables(self):
+        import batch
+        x = pl.parse("(lambda (n) (begin (define m (* n n))"
+                     "                   (if (null? m) '(a) (f m))))")
+        self.assertEqual({'*', 'f'}, batch.free_variables(x))
+        self.assertRaises(batch.Impure, batch.free_variables, pl.parse("(set! x 1)"))
+        self.assertRaises(batch.Impure, batch.free_variables,
+                          pl.parse("(begin (define x 1) x)"))
+
+    def test_groups(self):
+        import batch
+        forms = [(1, 1, pl.parse(s)) for s in [
+            "(define sq (lambda (x) (* x x)))", "(define a (sq 3))",
+            "(define b (sq 4))", "(define c (+ a b))", "(define d (print c))"]]
+        groups = []
+        run = batch.Scheduler.run
+
+        def record(scheduler, group):
+            if group:
+                groups.append([form[1] for _, _, form, _, _, _ in group])
+            return run(scheduler, group)
+        with mock.patch.object(batch.Scheduler, 'run', record):
+            for _, _, _, get_value in batch.Scheduler().schedule(forms):
+                get_value()
+        self.assertEqual([['sq'], ['a', 'b'], ['c']], groups)
+        self.assertEqual(25, pl.evaluate(pl.parse("c")))
+
+    def test_rebound_callee(self):
+        import batch
+        forms = [(1, 1, pl.parse(s)) for s in [
+            "(define h (lambda (x) (* x 2)))", "(define g (lambda () (h 21)))",
+            "(define h print)", "(define u (g))"]]
+        groups = []
+        run = batch.Scheduler.run
+
+        def record(scheduler, group):
+            if group:
+                groups.append([form[1] for _, _, form, _, _, _ in group])
+            return run(scheduler, group)
+        with mock.patch.object(batch.Scheduler, 'run', record), \
+                contextlib.redirect_stdout(io.StringIO()):
+            for _, _, _, get_value in batch.Scheduler().schedule(forms):
+                get_value()
+        self.assertEqual([['h'], ['g']], groups)
+
+    @mock.patch('os.cpu_count', return_value=2)
+    def test_globals_read_by_callee(self, cpu_count):
+        with open(self.filename, "w") as f:
+            f.write("""(define z 1)
+                       (define f (lambda () z))
+                       (print "flush")
+                       (define z 2)
+                       (define w (f))
+                       (define v (f))""")
+        with contextlib.redirect_stdout(io.StringIO()):
+            pl.FileLoader(self.filename, batch=True)
+        self.assertEqual([2, 2], pl.evaluate(pl.parse("(list w v)")))
+
+    @mock.patch('os.cpu_count', return_value=2)
+    def test_same_results(self, cpu_count):
+        with open(self.filename, "w") as f:
+            f.write("""(define fact (lambda (n) (if (< n 2) 1 (* n (fact (- n 1))))))
+                       (define f10 (fact 10))
+                       (define f12 (fact 12))
+                       (define items (list f10 f12))
+                       (define batch-error (car 1))
+                       (define after-error 1)""")
+        pl.evaluate(pl.parse("(define after-error 0)"))
+        pl.FileLoader(self.filename, batch=True)
+        self.assertEqual([3628800, 479001600], pl.evaluate(pl.parse("items")))
+        self.assertEqual(0, pl.evaluate(pl.parse("after-error")))
+
 
 class TestLogic(unittest.TestCase):
 
@@ -150,6 +385,19 @@ class TestLogic(unittest.TestCase):
         self.assertEqual(3, pl.evaluate(pl.parse("(abs2 -3)")))
         self.assertEqual(0, pl.evaluate(pl.parse("(abs2 0)")))
 
+    def test_and_or(self):
+        self.assertEqual(True, pl.evaluate(pl.parse("(and #t 1 '(1))")))
+        self.assertEqual(False, pl.evaluate(pl.parse("(and #t #f)")))
+        self.assertEqual(True, pl.evaluate(pl.parse("(or #f 2)")))
+        self.assertEqual(False, pl.evaluate(pl.parse("(or)")))
+        pl.evaluate(pl.parse("(define both (lambda (a b) (and a b)))"))
+        self.assertEqual(False, pl.evaluate(pl.parse("(both 1 '())")))
+
+    def test_and_or_short_circuit(self):
+        # undefined-variable would raise an exception if evaluated
+        self.assertEqual(False, pl.evaluate(pl.parse("(and #f undefined-variable)")))
+        self.assertEqual(True, pl.evaluate(pl.parse("(or #t undefined-variable)")))
+
 
 class TestLists(unittest.TestCase):
 
@@ -171,5 +419,846 @@ class TestLists(unittest.TestCase):
         pl.evaluate(pl.parse(expr))
         self.assertEqual(pl.evaluate(pl.parse("'(2 3 4)")), pl.evaluate(pl.parse(expr2)))
 
+    def test_cdr_shares_structure(self):
+        pl.evaluate(pl.parse("(define a '(1 2 3))"))
+        pl.evaluate(pl.parse("(define b (cdr a))"))
+        a, b = pl.evaluate(pl.parse("a")), pl.evaluate(pl.parse("b"))
+        self.assertIs(a.cdr, b)
+        self.assertIs(b, pl.evaluate(pl.parse("(cdr (cons 0 b))")))
+
+    def test_null(self):
+        self.assertTrue(pl.evaluate(pl.parse("(null? '())")))
+        self.assertTrue(pl.evaluate(pl.parse("(null? (cdr '(1)))")))
+        self.assertFalse(pl.evaluate(pl.parse("(null? '(1))")))
+
+    def test_python_lists(self):
+        pl.global_env['py-list'] = [1, [2, 3], 4]
+        self.assertEqual(pl.evaluate(pl.parse("'((2 3) 4)")),
+                         pl.evaluate(pl.parse("(cdr py-list)")))
+        split = pl.parse('(with-py-inst "a b" \'split)')
+        self.assertEqual(['a', 'b'], pl.evaluate(split))
+        self.assertIsInstance(pl.evaluate(split), pl.Pair)
+        self.assertEqual("a-b",
+                         pl.evaluate(pl.parse('(with-py-inst "-" \'join \'(a b))')))
+
+    def test_long_list(self):
+        pl.global_env['long-list'] = list(range(5000))
+        self.assertEqual(list(range(5000)),
+                         pl.evaluate(pl.parse("(append '(0) long-list)")).cdr)
+        self.assertEqual(4999, pl.evaluate(pl.parse("(last long-list)")))
+        self.assertEqual(5000, pl.evaluate(pl.parse("(length long-list)")))
+
+    def test_list_procedures(self):
+        self.assertEqual([1, 2, 3], pl.evaluate(pl.parse("(list 1 2 3)")))
+        self.assertEqual([1, 2, 3, 4],
+                         pl.evaluate(pl.parse("(append '(1) '(2 3) '(4))")))
+        self.assertEqual([3, 2, 1], pl.evaluate(pl.parse("(reverse '(1 2 3))")))
+        self.assertEqual(10, pl.evaluate(pl.parse("(add 1 2 3 4)")))
+
+    def test_higher_order_procedures(self):
+        pl.evaluate(pl.parse("(define square (lambda (x) (* x x)))"))
+        self.assertEqual([1, 4, 9], pl.evaluate(pl.parse("(map square '(1 2 3))")))
+        self.assertEqual([5, 7], pl.evaluate(pl.parse("(map + '(1 2) '(4 5))")))
+        self.assertEqual([3, 4], pl.evaluate(
+            pl.parse("(filter (lambda (x) (> x 2)) '(1 2 3 4))")))
+        self.assertEqual(24, pl.evaluate(pl.parse("(reduce * '(1 2 3 4))")))
+        self.assertEqual(10, pl.evaluate(pl.parse("(reduce + '(1 2 3) 4)")))
+
+    def test_to_string(self):
+        repl = pl.InteractiveInterpreter()
+        self.assertEqual("(1 (2 #t) ())",
+                         repl.to_string(pl.evaluate(pl.parse("'(1 (2 #t) ())"))))
+
+
+class TestPrinter(unittest.TestCase):
+    '''Writing values, a chunk at a time and without recursion'''
+
+    def test_limits(self):
+        exp = pl.parse("(1 (2 (3)) 4 5)")
+        self.assertEqual("(1 (2 #) 4 ...)",
+                         pl.Printer(length=3, depth=2).to_string(exp))
+        repl = pl.InteractiveInterpreter()
+        pl.evaluate(pl.parse("(define print-length 2)"))
+        try:
+            self.assertEqual("(1 (2 (3)) ...)", repl.to_string(exp))
+        finally:
+            pl.global_env['print-length'] = False
+        self.assertEqual("(1 (2 (3)) 4 5)", repl.to_string(exp))
+
+    def test_cycles(self):
+        items = [1, 2]
+        items.append(items)
+        self.assertEqual("#0=(1 2 #0#)", pl.Printer().to_string(items))
+        lst = pl.Pair.from_list([1, 2, 3])
+        lst.cdr.cdr.cdr = lst.cdr
+        self.assertEqual("(1 . #0=(2 3 . #0#))", pl.Printer().to_string(lst))
+
+    def test_shared(self):
+        shared = pl.Pair.from_list([1, 2])
+        exp = [shared, shared, pl.Lisp.cons(0, shared)]
+        self.assertEqual("((1 2) (1 2) (0 1 2))", pl.Printer().to_string(exp))
+        self.assertEqual("(#0=(1 2) #0# (0 . #0#))",
+                         pl.Printer(shared=True).to_string(exp))
+
+    def test_large(self):
+        nested = pl.NIL
+        for _ in range(10000):
+            nested = pl.Pair(nested, pl.NIL)
+        self.assertEqual("(" * 10000 + "()" + ")" * 10000,
+                         pl.Printer().to_string(nested))
+        stream = mock.Mock()
+        pl.Printer().write(pl.Pair.from_list(list(range(10000))), stream)
+        self.assertLess(1, stream.write.call_count)
+        text = ''.join(call[0][0] for call in stream.write.call_args_list)
+        self.assertEqual("(0 1 2", text[:6])
+        self.assertEqual("9998 9999)", text[-10:])
+
+
+class TestScope(unittest.TestCase):
+    '''Ensures that variables are found in the correct environment'''
+
+    def test_closure(self):
+        pl.evaluate(pl.parse("(define make-adder (lambda (n) (lambda (x) (+ x n))))"))
+        pl.evaluate(pl.parse("(define add3 (make-adder 3))"))
+        self.assertEqual(7, pl.evaluate(pl.parse("(add3 4)")))
+
+    def test_set_captured_variable(self):
+        pl.evaluate(pl.parse("""(define make-counter (lambda (n)
+                                  (lambda () (begin (set! n (+ n 1)) n))))"""))
+        pl.evaluate(pl.parse("(define counter (make-counter 0))"))
+        pl.evaluate(pl.parse("(counter)"))
+        self.assertEqual(2, pl.evaluate(pl.parse("(counter)")))
+
+    def test_local_define(self):
+        pl.evaluate(pl.parse("(define y 1)"))
+        pl.evaluate(pl.parse("(define f (lambda (x)"
+                             "  (begin (define y (* x 2)) (+ x y))))"))
+        self.assertEqual(9, pl.evaluate(pl.parse("(f 3)")))
+        self.assertEqual(1, pl.evaluate(pl.parse("y")))
+
+    def test_define_in_cond(self):
+        pl.evaluate(pl.parse("(define k 1000)"))
+        pl.evaluate(pl.parse("""(define mk2 (lambda (n)
+                                  (cond ((> n 0) (begin (define k n)
+                                                        (lambda (x) (+ x k)))))))"""))
+        pl.evaluate(pl.parse("(define a5 (mk2 5))"))
+        for _ in range(3):      # once translated, with the jit
+            self.assertEqual(6, pl.evaluate(pl.parse("(a5 1)")))
+        self.assertEqual(1000, pl.evaluate(pl.parse("k")))
+
+    def test_module_loaded_in_enclosing_procedure(self):
+        pl.evaluate(pl.parse("""(define mk (lambda ()
+                                  (begin (load-py 'keyword)
+                                         (lambda (x) (iskeyword x)))))"""))
+        pl.evaluate(pl.parse("(define is-keyword (mk))"))
+        for _ in range(3):
+            self.assertTrue(pl.evaluate(pl.parse('(is-keyword "while")')))
+        self.assertNotIn('iskeyword', pl.global_env)
+
+    def test_undefined_in_procedure(self):
+        pl.evaluate(pl.parse("(define g (lambda () no-such-variable))"))
+        for _ in range(3):
+            with self.assertRaisesRegex(ValueError, "no-such-variable is not defined"):
+                pl.evaluate(pl.parse("(g)"))
+
+    def test_rebound_operator(self):
+        pl.set_folding(True)
+        try:
+            pl.evaluate(pl.parse("(define f (lambda () (+ 1 2)))"))
+            self.assertEqual(3, pl.evaluate(pl.parse("(f)")))
+            pl.evaluate(pl.parse("(define + my_prod)"))
+            self.assertEqual(2, pl.evaluate(pl.parse("(f)")))
+        finally:
+            pl.global_env['+'] = pl.global_env['my_sum']
+            pl.set_folding(False)
+
+    def test_operator_set_by_call(self):
+        pl.set_folding(True)
+        try:
+            pl.evaluate(pl.parse("(define setplus (lambda () (set! + my_prod)))"))
+            self.assertEqual(6, pl.evaluate(pl.parse("(begin (setplus) (+ 2 3))")))
+            pl.evaluate(pl.parse("(define + my_sum)"))
+            pl.evaluate(pl.parse("(define f (lambda () (begin (setplus) (+ 2 3))))"))
+            self.assertEqual(6, pl.evaluate(pl.parse("(f)")))
+        finally:
+            pl.global_env['+'] = pl.global_env['my_sum']
+            pl.set_folding(False)
+
+    def test_shadowing(self):
+        pl.evaluate(pl.parse("(define x 10)"))
+        pl.evaluate(pl.parse("(define g (lambda (x) (* x x)))"))
+        self.assertEqual(4, pl.evaluate(pl.parse("(g 2)")))
+        self.assertEqual(10, pl.evaluate(pl.parse("x")))
+
+
+class TestCalls(unittest.TestCase):
+    '''Python functions are given the environment only if they take it'''
+
+    def test_type_error_raised_once(self):
+        fail = mock.Mock(side_effect=TypeError("bad argument"))
+        pl.global_env['fail'] = lambda x, env=None: fail(x)
+        pl.evaluate(pl.parse("(define call-fail (lambda (x) (fail x)))"))
+        self.assertRaises(TypeError, pl.evaluate, pl.parse("(call-fail 1)"))
+        self.assertEqual(1, fail.call_count)
+
+    def test_env_given(self):
+        def with_env(x, env=None):
+            return x, env
+        pl.global_env['with-env'] = with_env
+        pl.evaluate(pl.parse("(define call-env (lambda (x) (with-env x)))"))
+        self.assertIsNotNone(pl.evaluate(pl.parse("(call-env 1)"))[1])
+        self.assertTrue(pl.receives_env(with_env))
+        self.assertFalse(pl.receives_env(pl.global_env['car']))
+
+    def test_no_reference_kept(self):
+        pl.evaluate(pl.parse('(define upper (lambda (s) ((py-method s \'upper))))'))
+        self.assertEqual("A", pl.evaluate(pl.parse('(upper "a")')))
+        size = len(pl.ENV_RECEIVERS) + len(pl.ENV_RECEIVER_OBJECTS)
+        for _ in range(100):
+            pl.evaluate(pl.parse('(upper "a")'))
+        self.assertEqual(size, len(pl.ENV_RECEIVERS) + len(pl.ENV_RECEIVER_OBJECTS))
+
+
+class TestAttributeCache(unittest.TestCase):
+    '''Methods called by with-py-inst are looked up once for each type,
+       except by the interpret engine'''
+
+    def test_cached_for_type(self):
+        pl.evaluate(pl.parse("(define upper (lambda (s) (with-py-inst s 'upper)))"))
+        pl.global_env['some-bytes'] = b"x"
+        for _ in range(2):      # the jit translates upper after its first call
+            pl.evaluate(pl.parse('(upper "z")'))
+        with mock.patch.object(pl.AttributeCache, 'lookup', autospec=True,
+                               side_effect=pl.AttributeCache.lookup) as lookup:
+            for word in ["a", "b", "c"]:
+                exp = pl.parse('(upper "{}")'.format(word))
+                self.assertEqual(word.upper(), pl.evaluate(exp))
+            self.assertEqual(0, lookup.call_count)
+            self.assertEqual(b"X", pl.evaluate(pl.parse("(upper some-bytes)")))
+            self.assertEqual(1, lookup.call_count)
+
+
+class TestPythonMethods(unittest.TestCase):
+    '''with-py-inst and py-method'''
+
+    def test_instance_attributes(self):
+        class Point:
+            def norm(self):
+                return 1
+        p, q = Point(), Point()
+        q.norm = lambda: 2
+        pl.global_env.update({'p': p, 'q': q})
+        pl.evaluate(pl.parse("(define norm (lambda (pt) (with-py-inst pt 'norm)))"))
+        self.assertEqual([1, 2, 1], [pl.evaluate(pl.parse("(norm {})".format(name)))
+                                     for name in ["p", "q", "p"]])
+
+    def test_rebound(self):
+        pl.evaluate(pl.parse("(define split (lambda (s) (with-py-inst s 'split)))"))
+        self.assertEqual(['a', 'b'], pl.evaluate(pl.parse('(split "a b")')))
+        pl.global_env['with-py-inst'] = lambda inst, attr: attr
+        try:
+            self.assertEqual('split', pl.evaluate(pl.parse('(split "a b")')))
+        finally:
+            pl.global_env['with-py-inst'] = pl.Python.with_instance
+
+    def test_py_method(self):
+        pl.evaluate(pl.parse('(define join (py-method "-" \'join))'))
+        self.assertEqual("a-b", pl.evaluate(pl.parse("(join '(a b))")))
+        self.assertIn("Concatenate", pl.evaluate(pl.parse("join")).__doc__)
+
+
+class TestLazyModules(unittest.TestCase):
+    '''load-py binds a module imported, and whose names are bound, on demand'''
+
+    def test_imported_when_used(self):
+        sys.modules.pop('colorsys', None)
+        size = len(pl.global_env)
+        pl.evaluate(pl.parse("(load-py 'colorsys)"))
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertLessEqual(len(pl.global_env), size + 1)
+        self.assertEqual(1/3, pl.evaluate(pl.parse("(py-get colorsys 'ONE_THIRD)")))
+        self.assertIn('colorsys', sys.modules)
+
+    def test_qualified_names(self):
+        pl.evaluate(pl.parse("(load-py 'colorsys)"))
+        pl.evaluate(pl.parse("(define hue (lambda (r g b)"
+                             "  (car (colorsys.rgb_to_hsv r g b))))"))
+        for _ in range(3):
+            self.assertEqual(0.5, pl.evaluate(pl.parse("(hue 0 1 1)")))
+        self.assertEqual(0.5, pl.evaluate(pl.parse("(car (rgb_to_hsv 0 1 1))")))
+
+    def test_definitions_first(self):
+        pl.evaluate(pl.parse("(define ONE_SIXTH 6)"))
+        pl.evaluate(pl.parse("(load-py 'colorsys)"))
+        self.assertEqual(6, pl.evaluate(pl.parse("ONE_SIXTH")))
+        self.assertEqual(1/6, pl.evaluate(pl.parse("colorsys.ONE_SIXTH")))
+
+    def test_unknown_module(self):
+        self.assertRaises(ImportError, pl.evaluate,
+                          pl.parse("(load-py 'no_such_module)"))
+
+
+class TestTailCalls(unittest.TestCase):
+    '''Ensures that calls in tail position do not use up the Python stack'''
+
+    def test_loop(self):
+        pl.evaluate(pl.parse("""(define loop (lambda (n)
+                                  (if (= n 0) 'done (loop (- n 1)))))"""))
+        self.assertEqual('done', pl.evaluate(pl.parse("(loop 5000)")))
+
+    def test_cond_and_begin(self):
+        pl.evaluate(pl.parse("""(define count (lambda (n acc)
+                                  (cond ((= n 0) acc)
+                                        (else (begin (define m (- n 1))
+                                                     (count m (+ acc 1)))))))"""))
+        self.assertEqual(5000, pl.evaluate(pl.parse("(count 5000 0)")))
+
+    def test_recursion_depth(self):
+        # with 1000 Python frames left, as when running a program, a
+        # recursion at least 180 deep works on every engine
+        depth, frame = 0, sys._getframe()
+        while frame is not None:
+            depth, frame = depth + 1, frame.f_back
+        pl.evaluate(pl.parse(
+            "(define f1 (lambda (n) (if (= n 0) 0 (+ 1 (f1 (- n 1))))))"))
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(depth + 1000)
+        try:
+            self.assertEqual(180, pl.evaluate(pl.parse("(f1 180)")))
+        finally:
+            sys.setrecursionlimit(limit)
+
+    def test_last(self):
+        pl.global_env['long-list'] = list(range(3000))
+        self.assertEqual(2999, pl.evaluate(pl.parse("(last long-list)")))
+
+
+class TestParallelMap(unittest.TestCase):
+    '''Ensures that procedures can be sent to other processes'''
+
+    def test_pickled_closure(self):
+        pl.evaluate(pl.parse("""(define make-counter (lambda (n)
+                                  (begin (define step (lambda (x) (+ x n)))
+                                         (lambda (x) (step (step x))))))"""))
+        add10 = pickle.loads(pickle.dumps(pl.evaluate(pl.parse("(make-counter 5)"))))
+        self.assertEqual(13, add10(3))
+
+    @mock.patch('os.cpu_count', return_value=2)
+    def test_pmap(self, cpu_count):
+        pl.evaluate(pl.parse("(define square (lambda (x) (* x x)))"))
+        self.assertEqual(pl.evaluate(pl.parse("(map square '(1 2 3 4 5))")),
+                         pl.evaluate(pl.parse("(pmap square '(1 2 3 4 5) 2)")))
+
+    def test_used_globals(self):
+        import prelude
+        pl.evaluate(pl.parse("(define half (lambda (x) (/ x 2)))"))
+        pl.evaluate(pl.parse("(define quarter (lambda (x) (half (half x))))"))
+        used = prelude.used_globals(pl.evaluate(pl.parse("quarter")))
+        self.assertLessEqual({'half', '/'}, set(used))
+        self.assertNotIn('quarter', used)
+        self.assertEqual(['half'], list(prelude.symbols(pl.parse('("quote" half)'))))
+
+
+class TestMemoize(unittest.TestCase):
+
+    def test_define_memo(self):
+        pl.evaluate(pl.parse("""(define-memo mfib (lambda (n)
+                                  (if (< n 2) n
+                                      (+ (mfib (- n 1)) (mfib (- n 2))))))"""))
+        self.assertEqual(1548008755920, pl.evaluate(pl.parse("(mfib 60)")))
+        mfib = pl.evaluate(pl.parse("mfib"))
+        self.assertEqual((58, 61), (mfib.hits, mfib.misses))
+        self.assertIn("58 hits, 61 misses", mfib.__doc__)
+
+    def test_lru(self):
+        pl.evaluate(pl.parse("(define total"
+                             "  (memoize (lambda (lst) (reduce + lst 0)) 2))"))
+        for lst in ["'(1 2)", "'(3 4)", "'(1 2)", "'(5 6)", "'(1 2)", "'(3 4)"]:
+            pl.evaluate(pl.parse("(total {})".format(lst)))
+        total = pl.evaluate(pl.parse("total"))
+        self.assertEqual([(1, 2), (3, 4)],
+                         [tuple(item for _, item in key[0][1]) for key in total.cache])
+        self.assertEqual((2, 4), (total.hits, total.misses))
+
+    def test_typed_keys(self):
+        pl.evaluate(pl.parse("(define-memo dbl (lambda (x) (* x 2)))"))
+        for exp, value in [("(dbl 1)", 2), ("(dbl 1.0)", 2.0), ("(dbl #t)", 2)]:
+            result = pl.evaluate(pl.parse(exp))
+            self.assertEqual((value, type(value)), (result, type(result)), msg=exp)
+        pl.evaluate(pl.parse("(define-memo same (lambda (x) x))"))
+        self.assertEqual('abc', pl.evaluate(pl.parse("(same 'abc)")))
+        self.assertIsInstance(pl.evaluate(pl.parse('(same "abc")')), pl.String)
+
+
+class TestVectorArithmetic(unittest.TestCase):
+
+    def test_lists(self):
+        self.assertEqual([5, 7, 9], pl.evaluate(pl.parse("(+ '(1 2 3) '(4 5 6))")))
+        self.assertIsInstance(pl.evaluate(pl.parse("(+ '(1 2 3) '(4 5 6))")), pl.Pair)
+        self.assertEqual([2, 4.5], pl.evaluate(pl.parse("(* 2 '(1 2.25))")))
+        self.assertEqual([0, 1], pl.evaluate(pl.parse("(- '(1 2) 1)")))
+        self.assertEqual([-1, -2], pl.evaluate(pl.parse("(- '(1 2))")))
+        self.assertEqual(6, pl.evaluate(pl.parse("(sum '(1 2 3))")))
+        self.assertEqual(32, pl.evaluate(pl.parse("(dot '(1 2 3) '(4 5 6))")))
+
+    def test_in_procedure(self):
+        pl.evaluate(pl.parse("(define scale (lambda (k xs ys) (+ (* k xs) ys)))"))
+        self.assertEqual([12, 24], pl.evaluate(pl.parse("(scale 10 '(1 2) '(2 4))")))
+        self.assertEqual(14, pl.evaluate(pl.parse("(scale 10 1 4)")))
+
+    def test_different_lengths(self):
+        self.assertRaises(ValueError, pl.evaluate, pl.parse("(+ '(1 2) '(1 2 3))"))
+
+    def test_arrays(self):
+        import array
+        import my_math
+        xs = array.array('l', [1, 2, 3])
+        self.assertEqual(array.array('l', [2, 4, 6]), my_math.my_sum(xs, xs))
+        self.assertEqual(array.array('d', [0.5, 1.5, 2.5]), my_math.my_sub(xs, 0.5))
+        self.assertEqual(6, my_math.sum_items(xs))
+        self.assertEqual(14, my_math.dot(xs, xs))
+
+    def test_overflow(self):
+        import array
+        import my_math
+        xs = array.array('q', [2 ** 62, -2 ** 63, 1])
+
+        def results():
+            return [my_math.my_sum(xs, xs), my_math.my_prod(xs, 4), my_math.my_sub(xs),
+                    my_math.my_sum(xs, 1), my_math.sum_items(xs), my_math.dot(xs, xs)]
+        expected = [array.array('d', [2.0 ** 63, -2.0 ** 64, 2]),
+                    array.array('d', [2.0 ** 64, -2.0 ** 65, 4]),
+                    array.array('d', [-2.0 ** 62, 2.0 ** 63, -1]),
+                    array.array('q', [2 ** 62 + 1, -2 ** 63 + 1, 2]),
+                    -2 ** 62 + 1, 2 ** 124 + 2 ** 126 + 1]
+        self.assertEqual(expected, results())
+        with mock.patch.object(my_math, 'numpy', None):
+            self.assertEqual(expected, results())
+
+    def test_numbers_unchanged(self):
+        import my_math
+        self.assertEqual((6, 6, -1, 2),
+                         (my_math.my_sum(1, 2, 3), my_math.my_prod(1, 2, 3),
+                          my_math.my_sub(1), my_math.my_sub(3, 1)))
+
+
+class TestVectors(unittest.TestCase):
+
+    def test_literal(self):
+        v = pl.evaluate(pl.parse("#(1 2 3)"))
+        self.assertEqual(('q', [1, 2, 3]), (v.typecode, v.tolist()))
+        self.assertEqual('d', pl.evaluate(pl.parse("'#(1 2.5)")).typecode)
+        self.assertEqual(['define', 'v', pl.parse("#(1 2)")],
+                         pl.parse("(define v #(1 2))"))
+        with self.assertRaisesRegex(SyntaxError, "line 1, column 6"):
+            pl.parse("#(1 a)")
+
+    def test_procedures(self):
+        pl.evaluate(pl.parse("(define v (make-vector 3 1))"))
+        pl.evaluate(pl.parse("(vector-set! v 0 5)"))
+        self.assertEqual(5, pl.evaluate(pl.parse("(vector-ref v 0)")))
+        self.assertEqual(3, pl.evaluate(pl.parse("(vector-length v)")))
+        self.assertEqual([5, 1, 1], pl.evaluate(pl.parse("(vector->list v)")))
+        self.assertEqual([1, 2],
+                         pl.evaluate(pl.parse("(list->vector '(1 2))")).tolist())
+
+    def test_slice_shares_items(self):
+        pl.evaluate(pl.parse("(define v (vector 1 2 3 4))"))
+        pl.evaluate(pl.parse("(define s (vector-slice v 1 3))"))
+        pl.evaluate(pl.parse("(vector-set! s 0 20)"))
+        self.assertEqual(2, pl.evaluate(pl.parse("(vector-length s)")))
+        self.assertEqual([1, 20, 3, 4], pl.evaluate(pl.parse("v")).tolist())
+
+    def test_arithmetic(self):
+        pl.evaluate(pl.parse("(define double (lambda (v) (+ v v)))"))
+        v = pl.evaluate(pl.parse("(double #(1 2 3))"))
+        self.assertIsInstance(v, pl.vectors.Vector)
+        self.assertEqual([2, 4, 6], v.tolist())
+        self.assertEqual([0.5, 1.5], pl.evaluate(pl.parse("(* 0.5 #(1 3))")).tolist())
+        self.assertEqual([-1, -2], pl.evaluate(pl.parse("(- #(1 2))")).tolist())
+        self.assertEqual(6, pl.evaluate(
+            pl.parse("(sum (vector-slice #(1 2 3 4) 0 3))")))
+
+    def test_to_string(self):
+        repl = pl.InteractiveInterpreter()
+        self.assertEqual("#(1.0 2.5)",
+                         repl.to_string(pl.evaluate(pl.parse("#(1 2.5)"))))
+        self.assertEqual("(#(1) #(2 3))", repl.to_string(
+            pl.evaluate(pl.parse("(list #(1) (vector-slice #(1 2 3) 1))"))))
+
+    def test_memory(self):
+        import sys
+        items = list(range(1000, 11000))
+        lst = pl.Pair.from_list(items)
+        list_size = 0
+        while lst is not pl.NIL:
+            list_size += sys.getsizeof(lst) + sys.getsizeof(lst.car)
+            lst = lst.cdr
+        vector = pl.vectors.Vector.from_items(items)
+        self.assertLess(sys.getsizeof(vector) * 8, list_size)
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        pl.evaluate(pl.parse("(define pfib (lambda (n) (if (< n 2) n"
+                             "  (+ (pfib (- n 1)) (pfib (- n 2))))))"))
+
+    @mock.patch('builtins.print')
+    def test_counts(self, print):
+        import profiler
+        pfib = pl.evaluate(pl.parse("pfib"))
+        with profiler.Profiler() as p:
+            self.assertEqual(55, pl.evaluate(pl.parse("(pfib 10)")))
+        self.assertEqual(177, p.stats['pfib'].calls)
+        self.assertEqual(177, p.stats['<'].calls)
+        self.assertIs(pfib, pl.evaluate(pl.parse("pfib")))
+
+    @mock.patch('builtins.print')
+    def test_profile_form(self, print):
+        self.assertEqual(55, pl.evaluate(pl.parse("(profile (pfib 10))")))
+        self.assertTrue(any("pfib" in call[0][0] for call in print.call_args_list))
+        self.assertIsNone(pl.profiling)
+
+
+class TestProfileTailCalls(unittest.TestCase):
+
+    @mock.patch('builtins.print')
+    def test_loop(self, print):
+        pl.evaluate(pl.parse("(define ploop (lambda (n)"
+                             "  (if (= n 0) 'done (ploop (- n 1)))))"))
+        self.assertEqual('done', pl.evaluate(pl.parse("(profile (ploop 5000))")))
+
+
+class InterpretMixin:
+    '''Runs the tests of a TestCase using the tree-walking interpreter'''
+
+    def setUp(self):
+        pl.set_engine('interpret')
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        pl.set_engine('compile')
+
+
+class TestEvaluateInterpreted(InterpretMixin, TestEvaluate):
+    pass
+
+
+class TestLogicInterpreted(InterpretMixin, TestLogic):
+    pass
+
+
+class TestListsInterpreted(InterpretMixin, TestLists):
+    pass
+
+
+class TestScopeInterpreted(InterpretMixin, TestScope):
+    pass
+
+
+class TestTailCallsInterpreted(InterpretMixin, TestTailCalls):
+    pass
+
+
+class TestParallelMapInterpreted(InterpretMixin, TestParallelMap):
+    pass
+
+
+class TestProfileInterpreted(InterpretMixin, TestProfile):
+    pass
+
+
+class TestMemoizeInterpreted(InterpretMixin, TestMemoize):
+    pass
+
+
+class TestVectorArithmeticInterpreted(InterpretMixin, TestVectorArithmetic):
+    pass
+
+
+class TestVectorsInterpreted(InterpretMixin, TestVectors):
+    pass
+
+
+class TestCallsInterpreted(InterpretMixin, TestCalls):
+    pass
+
+
+class TestPythonMethodsInterpreted(InterpretMixin, TestPythonMethods):
+    pass
+
+
+class TestLazyModulesInterpreted(InterpretMixin, TestLazyModules):
+    pass
+
+
+class VMMixin:
+    '''Runs the tests of a TestCase using the bytecode compiler and vm'''
+
+    def setUp(self):
+        pl.set_engine('vm')
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        pl.set_engine('compile')
+
+
+class TestEvaluateVM(VMMixin, TestEvaluate):
+    pass
+
+
+class TestLogicVM(VMMixin, TestLogic):
+    pass
+
+
+class TestListsVM(VMMixin, TestLists):
+    pass
+
+
+class TestScopeVM(VMMixin, TestScope):
+    pass
+
+
+class TestTailCallsVM(VMMixin, TestTailCalls):
+    pass
+
+
+class TestParallelMapVM(VMMixin, TestParallelMap):
+    pass
+
+
+class TestProfileVM(VMMixin, TestProfile):
+    pass
+
+
+class TestProfileTailCallsVM(VMMixin, TestProfileTailCalls):
+    pass
+
+
+class TestMemoizeVM(VMMixin, TestMemoize):
+    pass
+
+
+class TestVectorArithmeticVM(VMMixin, TestVectorArithmetic):
+    pass
+
+
+class TestVectorsVM(VMMixin, TestVectors):
+    pass
+
+
+class TestCallsVM(VMMixin, TestCalls):
+    pass
+
+
+class TestPythonMethodsVM(VMMixin, TestPythonMethods):
+    pass
+
+
+class TestLazyModulesVM(VMMixin, TestLazyModules):
+    pass
+
+
+class TestAttributeCacheVM(VMMixin, TestAttributeCache):
+    pass
+
+
+class JitMixin:
+    '''Runs the tests of a TestCase translating procedures to Python
+       from their first call'''
+
+    def setUp(self):
+        import transpiler
+        self.hot = transpiler.HOT
+        transpiler.HOT = 1
+        pl.set_engine('jit')
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        import transpiler
+        transpiler.HOT = self.hot
+        pl.set_engine('compile')
+
+
+class TestEvaluateJit(JitMixin, TestEvaluate):
+    pass
+
+
+class TestLogicJit(JitMixin, TestLogic):
+    pass
+
+
+class TestScopeJit(JitMixin, TestScope):
+    pass
+
+
+class TestTailCallsJit(JitMixin, TestTailCalls):
+    pass
+
+
+class TestParallelMapJit(JitMixin, TestParallelMap):
+    pass
+
+
+class TestProfileJit(JitMixin, TestProfile):
+    pass
+
+
+class TestProfileTailCallsJit(JitMixin, TestProfileTailCalls):
+    pass
+
+
+class TestMemoizeJit(JitMixin, TestMemoize):
+    pass
+
+
+class TestVectorArithmeticJit(JitMixin, TestVectorArithmetic):
+    pass
+
+
+class TestVectorsJit(JitMixin, TestVectors):
+    pass
+
+
+class TestCallsJit(JitMixin, TestCalls):
+    pass
+
+
+class TestPythonMethodsJit(JitMixin, TestPythonMethods):
+    pass
+
+
+class TestLazyModulesJit(JitMixin, TestLazyModules):
+    pass
+
+
+class TestAttributeCacheJit(JitMixin, TestAttributeCache):
+    pass
+
+
+class FoldingMixin:
+    '''Runs the tests of a TestCase folding constants before evaluating'''
+
+    def setUp(self):
+        pl.set_folding(True)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        pl.set_folding(False)
+
+
+class TestEvaluateFolded(FoldingMixin, TestEvaluate):
+    pass
+
+
+class TestLogicFolded(FoldingMixin, TestLogic):
+    pass
+
+
+class TestFolding(unittest.TestCase):
+
+    def test_fold(self):
+        import folding
+        x = pl.parse("(lambda (x) (* x (+ (* 3 4) (- 2 1))))")
+        (_, guard, folded, body) = folding.fold(x)[2]
+        self.assertEqual((['*', 'x', 13], x[2]), (folded, body))
+        self.assertTrue(guard[0]())
+        self.assertEqual(['display', 2.5], folding.fold(pl.parse("(display (/ 5 2))")))
+        self.assertEqual(['/', 1, 0], folding.fold(pl.parse("(/ 1 0)")))
+
+    def test_branches(self):
+        import folding
+        self.assertEqual('a', folding.fold(pl.parse("(if (< 1 2) a b)")))
+        self.assertEqual(['cond', ['x', 'b'], ['else', 'c']],
+                         folding.fold(pl.parse("(cond (#f a) (x b) (else c) (y d))")))
+
+    def test_shadowing(self):
+        import folding
+        for expr in ["(lambda (+) (+ 1 2))", "(begin (define + my_prod) (+ 1 2))",
+                     "(lambda (else) (if else 1 2))", "(quote (+ 1 2))"]:
+            self.assertEqual(pl.parse(expr), folding.fold(pl.parse(expr)), msg=expr)
+
+
+class TestTranspiler(JitMixin, unittest.TestCase):
+
+    def test_translated(self):
+        import transpiler
+        pl.evaluate(pl.parse("(define square (lambda (x) (* x x)))"))
+        self.assertEqual(9, pl.evaluate(pl.parse("(square 3)")))
+        square = pl.evaluate(pl.parse("square"))
+        self.assertIsNotNone(square.tier.source)
+        self.assertIn("(_v0 * _v0)", transpiler.python_source(square))
+
+    def test_untranslatable(self):
+        pl.evaluate(pl.parse("(define f (lambda (x) (begin (set! x (+ x 1)) x)))"))
+        self.assertEqual(4, pl.evaluate(pl.parse("(f 3)")))
+        f = pl.evaluate(pl.parse("f"))
+        self.assertIsNone(f.tier.source)
+        self.assertIs(f.tier.closure, f.code)
+
+    def test_vector_arguments(self):
+        pl.global_env['py-list'] = [1, 2]
+        pl.global_env['py-array'] = array.array('l', [1, 2])
+        pl.evaluate(pl.parse("(define dbl (lambda (v) (* 2 v)))"))
+        pl.evaluate(pl.parse("(define add2 (lambda (a b) (+ a b)))"))
+        for _ in range(3):
+            self.assertEqual([2, 4], pl.evaluate(pl.parse("(dbl py-list)")))
+            self.assertEqual([2, 4], pl.evaluate(pl.parse("(dbl #(1 2))")).tolist())
+            self.assertEqual([2, 4],
+                             pl.evaluate(pl.parse("(add2 py-array py-array)")).tolist())
+            self.assertEqual(6, pl.evaluate(pl.parse("(dbl 3)")))
+        self.assertIsNotNone(pl.evaluate(pl.parse("dbl")).tier.source)
+
+    def test_redefined_operator(self):
+        pl.evaluate(pl.parse("(define plus (lambda (x y) (+ x y)))"))
+        self.assertEqual(5, pl.evaluate(pl.parse("(plus 2 3)")))
+        pl.evaluate(pl.parse("(define + my_prod)"))
+        try:
+            self.assertEqual(6, pl.evaluate(pl.parse("(plus 2 3)")))
+        finally:
+            pl.evaluate(pl.parse("(define + my_sum)"))
+
+
+class TestCompile(unittest.TestCase):
+    '''Ensures that analyzed expressions give the same result as
+       interpreted ones'''
+
+    def test_same_results(self):
+        pl.evaluate(pl.parse("(define fact (lambda (n)"
+                             "  (if (< n 2) 1 (* n (fact (- n 1))))))"))
+        for expr in ["(fact 10)", "(list 1 2 3)", "(last '(1 2 3))",
+                     "(cons (car '(1 2)) (cdr '(3 4 5)))", "(add 1 2 3 4)"]:
+            self.assertEqual(pl.interpret(pl.parse(expr)),
+                             pl.execute(pl.parse(expr)), msg=expr)
+
+    def test_procedure_body_is_analyzed_once(self):
+        pl.evaluate(pl.parse("(define twice (lambda (x) (* 2 x)))"))
+        twice = pl.evaluate(pl.parse("twice"))
+        self.assertIsInstance(twice, pl.CompiledProcedure)
+        code = twice.code
+        self.assertEqual(8, pl.evaluate(pl.parse("(twice 4)")))
+        self.assertIs(code, twice.code)
+
+    def test_vm_same_results(self):
+        import vm
+        pl.evaluate(pl.parse("(define fact (lambda (n)"
+                             "  (if (< n 2) 1 (* n (fact (- n 1))))))"))
+        for expr in ["(fact 10)", "(list 1 2 3)", "(last '(1 2 3))",
+                     "(cons (car '(1 2)) (cdr '(3 4 5)))", "(add 1 2 3 4)"]:
+            self.assertEqual(pl.execute(pl.parse(expr)),
+                             vm.execute(pl.parse(expr)), msg=expr)
+
+    def test_vm_deep_recursion(self):
+        import vm
+        vm.execute(pl.parse("(define count (lambda (n)"
+                            "  (if (= n 0) 0 (+ 1 (count (- n 1))))))"))
+        self.assertEqual(5000, vm.execute(pl.parse("(count 5000)")))
+
+
 if __name__ == '__main__':
     unittest.main()
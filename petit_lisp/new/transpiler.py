@@ -0,0 +1,387 @@
+'''Translation of petit_lisp procedures into Python functions
+
+With the "jit" engine, lambda expressions are analyzed as usual but the
+resulting procedures count how often they are called.  When a lambda
+expression has been called HOT times, its body is translated into the
+source of a Python function, compiled with compile(), and this function
+replaces the closure made by the Analyzer as the code of all the
+procedures made from that lambda expression.
+
+Like those closures, the generated function takes the procedure's Frame
+as its only argument.  Parameters become Python local variables, calls
+of a procedure to itself in tail position become a loop, and calls to
++, * and - are written as Python operators when they are bound to the
+functions of my_math and given a suitable number of arguments; these
+operators are used only for numbers and petit_lisp lists, for which
+they give the same result as my_math: other arguments, such as Python
+lists or arrays, are given to the functions of my_math.
+
+The variables of the global environment are read from global_env,
+which must then be the environment the procedure was made in: when
+an enclosing procedure has bound names at run time, the procedure runs
+the code made by the Analyzer instead.
+
+Bodies using forms that are not supported, such as define, set! or
+lambda, or calling procedures that need the environment, such as
+load-py, are not translated: their procedures keep running the code
+made by the Analyzer.
+
+usage: python petit_lisp.py --engine jit [--dump-py]
+'''
+
+import re
+
+import my_math
+import petit_lisp as pl
+
+HOT = 50         # number of calls after which a lambda expression is translated
+DUMP = False     # print the generated Python code
+
+INLINE_OPERATORS = {my_math.my_sum: '+', my_math.my_prod: '*', my_math.my_sub: '-'}
+# types whose Python operators give the same result as my_math
+INLINE_TYPES = (int, float, bool, complex, pl.Pair, pl.Nil)
+SIMPLE_EXPRESSION = re.compile(r'_v\d+|_k\[\d+\]\Z')     # a local or a constant
+
+
+class Untranslatable(Exception):
+    '''Raised when a body contains a form that is not supported'''
+    pass
+
+
+class Tier:
+    '''The code shared by all the procedures made from a lambda expression:
+       initially the closure made by the Analyzer, replaced by a Python
+       function once the lambda expression has been called often enough.'''
+
+    def __init__(self, params, body, closure, scope):
+        self.params, self.body, self.scope = params, body, scope
+        self.closure = closure
+        self.code = self.count_call
+        self.calls = 0
+        self.source = None
+
+    def count_call(self, env):
+        '''Code used until the lambda expression has been called HOT times'''
+        self.calls += 1
+        if self.calls >= HOT:
+            try:
+                self.code = translate(self)
+            except Untranslatable:
+                self.code = self.closure
+        return self.closure(env)
+
+
+class HotProcedure(pl.CompiledProcedure):
+    '''A user-defined procedure whose code is translated into a Python
+       function when called often'''
+    def __init__(self, params, body, env, opt_param, tier, nlocals=0):
+        pl.Procedure.__init__(self, params, body, env, opt_param)
+        self.tier = tier
+        self.nlocals = nlocals
+
+    @property
+    def code(self):
+        return self.tier.code
+
+    @property
+    def scope(self):
+        return self.tier.scope
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['tier']
+        state['scope'] = self.tier.scope
+        return state
+
+    def __setstate__(self, state):
+        scope = state.pop('scope')
+        self.__dict__.update(state)
+        self.tier = Tier(self.params, self.body,
+                         analyze(self.body, scope, tail=True), scope)
+
+
+class JitAnalyzer(pl.Analyzer):
+    '''Analyzer making procedures that are translated when called often'''
+
+    def make_procedure(self, params, body, opt_param, code, scope):
+        nlocals = len(scope.slots) - scope.nparams
+        tier = Tier(params, body, code, scope)
+        return lambda env: HotProcedure(params, body, env, opt_param, tier, nlocals)
+
+
+analyze = JitAnalyzer().analyze
+
+
+def execute(x, env=pl.global_env):
+    "Evaluate an expression by analyzing it first, then running the result."
+    return analyze(x)(env)
+
+
+class Translator:
+    '''Writes the source of a Python function equivalent to the body of a
+       lambda expression; the names it uses, such as _g for the global
+       environment, are defined in self.namespace.'''
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.scope = tier.scope
+        self.constants = []
+        self.guards = {}     # name: constant bound to it when translated
+        self.namespace = {'_g': pl.global_env, '_k': self.constants,
+                          '_undefined': undefined,
+                          '_tier': tier, '_fallback': tier.closure,
+                          '_cons': pl.Lisp.cons, '_null': pl.Lisp.is_null,
+                          '_TailCall': pl.TailCall,
+                          '_CompiledProcedure': pl.CompiledProcedure,
+                          '_HotProcedure': HotProcedure,
+                          '_inline_types': INLINE_TYPES}
+        self.loops = False
+        self.temporaries = 0
+        self.uses_globals = False
+
+    def translate(self):
+        '''Returns the source of a function named _lisp_procedure'''
+        if self.scope.nparams != len(self.scope.slots):
+            raise Untranslatable("local definitions")
+        body = self.tail(self.tier.body, '        ')
+        lines = ['def _lisp_procedure(_env):']
+        if self.uses_globals or self.guards:
+            lines.append('    if {}:'.format(self.global_env_check()))
+            lines.append('        return _fallback(_env)')
+        for name, value in self.guards.items():
+            lines.append('    if _g.get({!r}) is not {}:'.format(name, value))
+            lines.append('        return _fallback(_env)')
+        if self.scope.nparams:
+            lines.append('    {}, = _env.values'.format(
+                ', '.join(self.local(slot) for slot in range(self.scope.nparams))))
+        if self.loops:
+            lines.append('    while True:')
+            lines.extend(body)
+        else:
+            lines.extend(line[4:] for line in body)
+        return '\n'.join(lines) + '\n'
+
+    def global_env_check(self):
+        '''Returns a condition true when the variables that are not bound
+           lexically might not be those of _g: the procedure was made in
+           another Env, or an enclosing Frame has an extra Env, such as
+           one made by (load-py 'module) in the body of an enclosing
+           lambda.'''
+        env, frames, scope = '_env.outer', [], self.scope.outer
+        while scope is not None:
+            frames.append(env)
+            env, scope = env + '.outer', scope.outer
+        return ' or '.join(['{}.extra is not None'.format(frame) for frame in frames] +
+                           ['{} is not _g'.format(env)])
+
+    def local(self, slot):
+        return '_v{}'.format(slot)
+
+    def constant(self, value):
+        if type(value) is int:
+            return repr(value)
+        self.constants.append(value)
+        return '_k[{}]'.format(len(self.constants) - 1)
+
+    def tail(self, x, indent):
+        '''Returns the lines of statements returning the value of x'''
+        if isinstance(x, list) and x and type(x[0]) is str:
+            first = x[0]
+            if first == 'if':
+                (_, test, if_true, other) = x
+                return ([indent + 'if {}:'.format(self.expr(test))] +
+                        self.tail(if_true, indent + '    ') +
+                        [indent + 'else:'] + self.tail(other, indent + '    '))
+            elif first == 'cond':
+                lines = []
+                for keyword, (p, e) in zip(['if'] + ['elif'] * len(x), x[1:]):
+                    lines.append(indent + '{} {}:'.format(keyword, self.expr(p)))
+                    lines.extend(self.tail(e, indent + '    '))
+                return lines + [indent + 'return None']
+            elif first == 'begin' and len(x) > 1:
+                return ([indent + self.expr(exp) for exp in x[1:-1]] +
+                        self.tail(x[-1], indent))
+            elif first not in pl.analyzer.special_forms:
+                return self.tail_call(x, indent)
+        return [indent + 'return ' + self.expr(x)]
+
+    def tail_call(self, x, indent):
+        if self.operator(x[0], len(x) - 1) is not None or self.is_attribute_call(x):
+            return [indent + 'return ' + self.expr(x)]
+        procedure = self.expr(x[0])
+        args = [self.expr(exp) for exp in x[1:]]
+        lines = [indent + '_f = ' + procedure]
+        if self.is_self(x[0]) and len(args) == self.scope.nparams:
+            self.loops = True
+            lines.extend([
+                indent + 'if (type(_f) is _HotProcedure and _f.tier is _tier'
+                         ' and _f.env is _env.outer):',
+                indent + '    {}, = {},'.format(
+                    ', '.join(self.local(slot) for slot in range(len(args))) or '_',
+                    ', '.join(args) or 'None'),
+                indent + '    continue'])
+        return lines + [
+            indent + 'if isinstance(_f, _CompiledProcedure):',
+            indent + '    return _TailCall(_f, [{}])'.format(', '.join(args)),
+            indent + 'return _f({})'.format(', '.join(args))]
+
+    def is_self(self, x):
+        '''True if x is a global variable bound to a procedure made from
+           the lambda expression being translated'''
+        if not isinstance(x, str) or self.scope.address(x) is not None:
+            return False
+        value = pl.global_env.get(x)
+        return (isinstance(value, HotProcedure) and value.tier is self.tier
+                and not value.opt_param)
+
+    def expr(self, x):
+        '''Returns a Python expression for the value of x'''
+        if isinstance(x, pl.String):
+            return self.constant(x)
+        elif isinstance(x, str):
+            return self.variable(x)
+        elif not isinstance(x, list):
+            return self.constant(x)
+        first = x[0]
+        if type(first) is str:
+            if first == 'quote':
+                (_, exp) = x
+                return self.constant(pl.to_lisp(exp))
+            elif first == 'if':
+                (_, test, if_true, other) = x
+                return '({} if {} else {})'.format(
+                    self.expr(if_true), self.expr(test), self.expr(other))
+            elif first == 'cond':
+                result = 'None'
+                for (p, e) in reversed(x[1:]):
+                    result = '({} if {} else {})'.format(
+                        self.expr(e), self.expr(p), result)
+                return result
+            elif first == 'begin':
+                if len(x) == 1:
+                    return 'None'
+                return '({},)[-1]'.format(', '.join(self.expr(e) for e in x[1:]))
+            elif first == 'null?':
+                (_, exp) = x
+                return '_null({})'.format(self.expr(exp))
+            elif first in ('and', 'or'):
+                if len(x) == 1:
+                    return repr(first == 'and')
+                return 'bool({})'.format(
+                    ' {} '.format(first).join(self.expr(e) for e in x[1:]))
+            elif first == 'cons':
+                (_, exp1, exp2) = x
+                return '_cons({}, {})'.format(self.expr(exp1), self.expr(exp2))
+            elif first in pl.analyzer.special_forms:
+                raise Untranslatable(first)
+        return self.call(x)
+
+    def variable(self, var):
+        address = self.scope.address(var)
+        if address is None:
+            self.uses_globals = True
+            if var in pl.global_env:      # global variables are never removed
+                return '_g[{!r}]'.format(var)
+            return '(_g[{0!r}] if {0!r} in _g else _undefined({0!r}))'.format(var)
+        depth, slot = address
+        if depth == 0:
+            return self.local(slot)
+        return '_env' + '.outer' * depth + '.values[{}]'.format(slot)
+
+    def call(self, x):
+        if self.is_attribute_call(x):
+            return self.attribute_call(x)
+        args = [self.expr(exp) for exp in x[1:]]
+        operator = self.operator(x[0], len(args))
+        if operator is not None:
+            if x[0] not in self.guards:
+                self.guards[x[0]] = self.constant(pl.global_env[x[0]])
+            return self.inline(operator, self.guards[x[0]], args)
+        procedure = x[0]
+        if isinstance(procedure, str) and self.scope.address(procedure) is None:
+            value = pl.global_env.get(procedure)
+            if callable(value) and pl.receives_env(value):
+                raise Untranslatable(procedure)
+        return '{}({})'.format(self.expr(procedure), ', '.join(args))
+
+    def inline(self, operator, function, args):
+        '''Returns an expression applying operator to args if they are
+           numbers or petit_lisp lists, and calling function otherwise;
+           each argument is evaluated once, into a temporary variable.'''
+        names, checks = [], []
+        for arg in args:
+            if arg.lstrip('-').isdigit():        # an int constant
+                names.append(arg)
+                continue
+            if SIMPLE_EXPRESSION.match(arg):
+                name, check = arg, 'type({}) in _inline_types'.format(arg)
+            else:
+                name = '_t{}'.format(self.temporaries)
+                self.temporaries += 1
+                check = 'type({} := {}) in _inline_types'.format(name, arg)
+            names.append(name)
+            if check not in checks:
+                checks.append(check)
+        if len(names) == 1:
+            result = '({}{})'.format(operator, names[0])
+        else:
+            result = '({})'.format(' {} '.format(operator).join(names))
+        if not checks:
+            return result
+        return '({} if ({}) else {}({}))'.format(
+            result, ') & ('.join(checks), function, ', '.join(names))
+
+    def is_attribute_call(self, x):
+        return (pl.is_attribute_call(x, self.scope) and
+                pl.global_env.get(x[0]) is pl.Python.with_instance)
+
+    def attribute_call(self, x):
+        '''(with-py-inst inst 'attr exp*), calling the AttributeCache of
+           this call site directly'''
+        if x[0] not in self.guards:
+            self.guards[x[0]] = self.constant(pl.global_env[x[0]])
+        args = [self.expr(exp) for exp in [x[1]] + x[3:]]
+        cache = self.constant(pl.AttributeCache(x[2][1]))
+        return '{}({})'.format(cache, ', '.join(args))
+
+    def operator(self, x, nargs):
+        '''Returns the Python operator equivalent to calling x with nargs
+           arguments, if any, given the current value of x'''
+        if not isinstance(x, str) or self.scope.address(x) is not None:
+            return None
+        value = pl.global_env.get(x)
+        try:
+            operator = INLINE_OPERATORS.get(value)
+        except TypeError:      # unhashable value
+            return None
+        if operator is None or nargs == 0:
+            return None
+        if operator == '-' and nargs > 2:
+            return None
+        if operator != '-' and nargs == 1:
+            return None
+        return operator
+
+
+def undefined(var):
+    '''Returns the value of a global variable that is not in global_env
+       yet, such as a name of a module loaded by load-py, or raises the
+       error of the other engines'''
+    return pl.global_env.find(var)[var]
+
+
+def python_source(procedure):
+    '''Returns the Python source a HotProcedure is, or would be, translated to'''
+    return Translator(procedure.tier).translate()
+
+
+def translate(tier):
+    '''Returns the Python function equivalent to the code of a Tier'''
+    translator = Translator(tier)
+    source = translator.translate()
+    tier.source = source
+    if DUMP:
+        print(source)
+    exec(compile(source, '<petit_lisp {}>'.format(tier.params), 'exec'),
+         translator.namespace)
+    return translator.namespace['_lisp_procedure']
@@ -0,0 +1,93 @@
+'''Lisp vectors of numbers, stored in an array.array
+
+A vector literal, #(1 2 3), is read as a Vector of integers, or of
+floats if one of its items is a float; its items are stored as machine
+numbers rather than as Python objects each referred to by a Pair, so
+that a long vector uses about a tenth of the memory of the same list.
+The type of the items of a vector is fixed when it is made: only
+numbers of that type, or integers in a vector of floats, can be put
+into it with vector-set!.
+
+(vector-slice v start end) gives the items of v from start to end,
+excluding end, without copying them: the slice is a memoryview which
+shares the memory of v, so that vector-set! on the slice changes v.
++, * and - are element-wise on vectors and their slices, as on lists
+(see my_math).
+'''
+
+import array
+
+from lists import ElementWise, Pair
+
+
+class Vector(ElementWise, array.array):
+    '''An array.array whose arithmetic is element-wise'''
+
+    @classmethod
+    def from_items(cls, items):
+        '''Returns a vector of integers, or of floats, with the given items'''
+        items = list(items)
+        if not all(type(item) in (int, float) for item in items):
+            raise TypeError("vector items must be integers or floats")
+        if all(type(item) is int for item in items):
+            try:
+                return cls('q', items)
+            except OverflowError:
+                pass
+        return cls('d', items)
+
+
+VECTOR_TYPES = (Vector, memoryview)
+
+
+def make_vector(*items):
+    '''Usage: (vector exp1 exp2 ...) ==> #(exp1 exp2 ...)'''
+    return Vector.from_items(items)
+
+
+def make_vector_of_length(length, fill=0):
+    '''Usage: (make-vector n [fill]) ==> a vector of n items equal to fill'''
+    return Vector.from_items([fill] * length)
+
+
+def vector_ref(vector, k):
+    '''Usage: (vector-ref v k) ==> the item of v at index k'''
+    return vector[k]
+
+
+def vector_set(vector, k, value):
+    '''Usage: (vector-set! v k value) ==> replaces the item of v at index k'''
+    vector[k] = value
+
+
+def vector_length(vector):
+    '''Usage: (vector-length v) ==> the number of items of v'''
+    return len(vector)
+
+
+def vector_slice(vector, start, end=None):
+    '''Usage: (vector-slice v start [end]) ==> the items of v from start
+       to end, sharing the memory of v'''
+    return memoryview(vector)[start:end]
+
+
+def vector_to_list(vector):
+    '''Usage: (vector->list v) ==> a list with the items of v'''
+    return Pair.from_list(vector.tolist())
+
+
+def list_to_vector(lst):
+    '''Usage: (list->vector lst) ==> a vector with the items of lst'''
+    return Vector.from_items(lst)
+
+
+builtins = {
+    'vector': make_vector,
+    'make-vector': make_vector_of_length,
+    'vector-ref': vector_ref,
+    'vector-set!': vector_set,
+    'vector-length': vector_length,
+    'vector-slice': vector_slice,
+    'vector->list': vector_to_list,
+    'list->vector': list_to_vector,
+}
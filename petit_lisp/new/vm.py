@@ -0,0 +1,320 @@
+'''Bytecode compiler and stack virtual machine for petit_lisp
+
+An expression is compiled into a flat list of (opcode, argument)
+instructions, run by a single loop.  Calls between procedures compiled
+for the vm are made by this loop, saving the caller's instructions,
+position and Frame on an explicit stack, rather than by a recursive
+Python call.
+
+Variables are found using the same Scope and Frame as those used by the
+Analyzer in petit_lisp.py; special forms the compiler does not know
+about are analyzed instead, and the resulting closure is run by a
+single CLOSURE instruction.
+
+usage: python petit_lisp.py --engine vm
+'''
+
+import petit_lisp as pl
+
+(CONST, LOCAL, OUTER_LOCAL, CHECKED_LOCAL, NAME, DEFINE_LOCAL, DEFINE_NAME,
+ SET_LOCAL, SET_NAME, POP, JUMP, JUMP_IF_FALSE, MAKE_PROCEDURE, CONS, NULL,
+ CALL, TAIL_CALL, RETURN, CLOSURE) = range(19)
+
+OPNAMES = ['CONST', 'LOCAL', 'OUTER_LOCAL', 'CHECKED_LOCAL', 'NAME',
+           'DEFINE_LOCAL', 'DEFINE_NAME', 'SET_LOCAL', 'SET_NAME', 'POP', 'JUMP',
+           'JUMP_IF_FALSE', 'MAKE_PROCEDURE', 'CONS', 'NULL', 'CALL',
+           'TAIL_CALL', 'RETURN', 'CLOSURE']
+
+
+class Code:
+    '''Instructions compiled from an expression or from a procedure body'''
+    __slots__ = ('instructions',)
+
+    def __init__(self, instructions):
+        self.instructions = instructions
+
+    def __call__(self, env):
+        '''Runs the code; like the closures made by the Analyzer, a Code
+           object can be the code of a CompiledProcedure'''
+        return run(self, env)
+
+    def __str__(self):
+        return '\n'.join('{:4} {:15} {}'.format(pc, OPNAMES[op], arg)
+                         for pc, (op, arg) in enumerate(self.instructions))
+
+
+class Template:
+    '''What is known about a lambda expression once it is compiled;
+       the MAKE_PROCEDURE instruction adds the Frame to make a VMProcedure'''
+    __slots__ = ('params', 'body', 'opt_param', 'code', 'nlocals', 'scope')
+
+    def __init__(self, params, body, opt_param, code, nlocals, scope):
+        self.params, self.body, self.opt_param = params, body, opt_param
+        self.code, self.nlocals, self.scope = code, nlocals, scope
+
+    def __repr__(self):
+        return '<lambda {}>'.format(self.params)
+
+
+class VMProcedure(pl.CompiledProcedure):
+    '''A user-defined procedure whose body has been compiled to bytecode;
+       calls between VMProcedures are made directly by the vm.'''
+
+    def make_code(self):
+        return compiler.compile_body(self.body, self.scope)
+
+
+class Compiler:
+    '''Compiles a parsed expression into a Code object'''
+
+    def __init__(self):
+        self.special_forms = {
+            'quote': self.compile_quote,
+            'cons': self.compile_cons,
+            'define': self.compile_define,
+            'set!': self.compile_set,
+            'lambda': self.compile_lambda,
+            'cond': self.compile_cond,
+            'if': self.compile_if,
+            'begin': self.compile_begin,
+            'null?': self.compile_null
+        }
+
+    def compile(self, x):
+        "Compiles an expression evaluated in the global environment."
+        code = []
+        self.emit(x, None, False, code)
+        code.append((RETURN, None))
+        return Code(code)
+
+    def emit(self, x, scope, tail, code):
+        '''Appends to code the instructions leaving the value of x on the stack;
+           tail is true if the value of x is the value of a procedure body.'''
+        if isinstance(x, pl.String):         # string literal
+            code.append((CONST, x))
+        elif isinstance(x, str):             # variable reference
+            self.emit_variable(x, scope, code)
+        elif not isinstance(x, list):        # constant literal
+            code.append((CONST, x))
+        else:
+            first = x[0]
+            if type(first) is str and first in self.special_forms:
+                self.special_forms[first](x, scope, tail, code)
+            elif type(first) is str and first in pl.analyzer.special_forms:
+                code.append((CLOSURE, pl.analyze(x, scope)))
+            elif pl.is_attribute_call(x, scope):     # with-py-inst and its cache
+                code.append((CLOSURE, pl.analyze(x, scope)))
+            else:
+                self.emit_call(x, scope, tail, code)
+
+    def emit_variable(self, var, scope, code):
+        address = scope.address(var) if scope is not None else None
+        if address is None:
+            code.append((NAME, var))
+            return
+        depth, slot = address
+        if slot >= pl.analyzer.nparams(scope, depth):
+            code.append((CHECKED_LOCAL, (depth, slot, var)))
+        elif depth == 0:
+            code.append((LOCAL, slot))
+        else:
+            code.append((OUTER_LOCAL, address))
+
+    def compile_quote(self, x, scope, tail, code):     # (quote exp), or 'exp
+        (_, exp) = x
+        code.append((CONST, pl.to_lisp(exp)))
+
+    def compile_cons(self, x, scope, tail, code):      # (cons exp1 exp2)
+        (_, exp1, exp2) = x
+        self.emit(exp1, scope, False, code)
+        self.emit(exp2, scope, False, code)
+        code.append((CONS, None))
+
+    def compile_define(self, x, scope, tail, code):    # (define var exp)
+        (_, var, exp) = x
+        self.emit(exp, scope, False, code)
+        if scope is not None and var in scope.slots:
+            code.append((DEFINE_LOCAL, scope.slots[var]))
+        else:
+            code.append((DEFINE_NAME, var))
+
+    def compile_set(self, x, scope, tail, code):       # (set! var exp)
+        (_, var, exp) = x
+        self.emit(exp, scope, False, code)
+        address = scope.address(var) if scope is not None else None
+        if address is None:
+            code.append((SET_NAME, var))
+        else:
+            code.append((SET_LOCAL, address))
+
+    def compile_lambda(self, x, scope, tail, code):    # (lambda (params*) body)
+        (_, params, body) = x
+        params = list(params)
+        opt_param = False
+        if '.' in params:
+            opt_param = params.index('.')
+            params.pop(opt_param)
+        local_scope = pl.Scope(params, pl.analyzer.local_definitions(body), scope)
+        nlocals = len(local_scope.slots) - len(params)
+        code.append((MAKE_PROCEDURE, Template(params, body, opt_param,
+                                              self.compile_body(body, local_scope),
+                                              nlocals, local_scope)))
+
+    def compile_body(self, body, scope):
+        "Compiles the body of a lambda expression, given its local scope."
+        code = []
+        self.emit(body, scope, True, code)
+        code.append((RETURN, None))
+        return Code(code)
+
+    def compile_cond(self, x, scope, tail, code):      # (cond (p1 e1) ... (pn en))
+        end_jumps = []
+        for (p, e) in x[1:]:
+            self.emit(p, scope, False, code)
+            next_clause = len(code)
+            code.append(None)                # JUMP_IF_FALSE, patched below
+            self.emit(e, scope, tail, code)
+            end_jumps.append(len(code))
+            code.append(None)                # JUMP, patched below
+            code[next_clause] = (JUMP_IF_FALSE, len(code))
+        code.append((CONST, None))
+        for pc in end_jumps:
+            code[pc] = (JUMP, len(code))
+
+    def compile_if(self, x, scope, tail, code):        # (if test if_true other)
+        (_, test, if_true, other) = x
+        self.emit(test, scope, False, code)
+        jump_if_false = len(code)
+        code.append(None)
+        self.emit(if_true, scope, tail, code)
+        jump = len(code)
+        code.append(None)
+        code[jump_if_false] = (JUMP_IF_FALSE, len(code))
+        self.emit(other, scope, tail, code)
+        code[jump] = (JUMP, len(code))
+
+    def compile_begin(self, x, scope, tail, code):     # (begin exp* exp_last)
+        if len(x) == 1:
+            code.append((CONST, None))
+            return
+        for exp in x[1:-1]:
+            self.emit(exp, scope, False, code)
+            code.append((POP, None))
+        self.emit(x[-1], scope, tail, code)
+
+    def compile_null(self, x, scope, tail, code):      # (null? exp)
+        (_, exp) = x
+        self.emit(exp, scope, False, code)
+        code.append((NULL, None))
+
+    def emit_call(self, x, scope, tail, code):         # ("procedure" exp*)
+        for exp in x:
+            self.emit(exp, scope, False, code)
+        code.append((TAIL_CALL if tail else CALL, len(x) - 1))
+
+
+compiler = Compiler()
+
+
+def run(code, env):
+    '''Runs compiled code in a given environment and returns its value'''
+    Frame = pl.Frame
+    cons, is_null = pl.Lisp.cons, pl.Lisp.is_null
+    stack = []
+    push, pop = stack.append, stack.pop
+    calls = []        # (instructions, pc, env) of the callers to return to
+    instructions = code.instructions
+    pc = 0
+    while True:
+        op, arg = instructions[pc]
+        pc += 1
+        if op == LOCAL:
+            push(env.values[arg])
+        elif op == NAME:
+            e = env
+            while type(e) is Frame:
+                if e.extra is not None and (arg in e.extra or e.extra.resolve(arg)):
+                    push(e.extra[arg])
+                    break
+                e = e.outer
+            else:
+                push(e[arg] if arg in e else e.find(arg)[arg])
+        elif op == CALL or op == TAIL_CALL:
+            if arg:
+                args = stack[-arg:]
+                del stack[-arg:]
+            else:
+                args = []
+            procedure = pop()
+            if type(procedure) is VMProcedure:
+                if op == CALL:
+                    calls.append((instructions, pc, env))
+                env = procedure.new_frame(args)
+                instructions = procedure.code.instructions
+                pc = 0
+            elif (op == TAIL_CALL and not calls
+                  and isinstance(procedure, pl.CompiledProcedure)):
+                return pl.TailCall(procedure, args)   # to the trampoline
+            else:
+                push(pl.call(procedure, args, env))
+        elif op == CONST:
+            push(arg)
+        elif op == JUMP_IF_FALSE:
+            if not pop():
+                pc = arg
+        elif op == RETURN:
+            if not calls:
+                return pop()
+            instructions, pc, env = calls.pop()
+        elif op == JUMP:
+            pc = arg
+        elif op == OUTER_LOCAL:
+            depth, slot = arg
+            e = env
+            for _ in range(depth):
+                e = e.outer
+            push(e.values[slot])
+        elif op == POP:
+            pop()
+        elif op == NULL:
+            push(is_null(pop()))
+        elif op == CONS:
+            tail = pop()
+            push(cons(pop(), tail))
+        elif op == CHECKED_LOCAL:
+            depth, slot, var = arg
+            e = env
+            for _ in range(depth):
+                e = e.outer
+            value = e.values[slot]
+            if value is pl.UNASSIGNED:
+                raise ValueError("{} is not defined".format(var))
+            push(value)
+        elif op == MAKE_PROCEDURE:
+            push(VMProcedure(arg.params, arg.body, env, arg.opt_param,
+                             arg.code, arg.nlocals, arg.scope))
+        elif op == DEFINE_LOCAL:
+            env.values[arg] = pop()
+            push(None)
+        elif op == DEFINE_NAME:
+            env[arg] = pop()
+            push(None)
+        elif op == SET_LOCAL:
+            depth, slot = arg
+            e = env
+            for _ in range(depth):
+                e = e.outer
+            e.values[slot] = pop()
+            push(None)
+        elif op == SET_NAME:
+            env.find(arg)[arg] = pop()
+            push(None)
+        elif op == CLOSURE:
+            push(arg(env))
+        else:
+            raise SystemError("vm: unknown opcode {}".format(op))
+
+
+def execute(x, env=pl.global_env):
+    "Evaluate an expression by compiling it, then running the bytecode."
+    return run(compiler.compile(x), env)